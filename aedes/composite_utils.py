@@ -0,0 +1,272 @@
+import os
+import json
+import math
+import time
+import hashlib
+import threading
+import urllib.request
+
+import ee
+
+from aedes.instrumentation_utils import instrumented_call, record_cache
+
+# Composites built in this process keyed by composite key, shared by every call
+_composites = {}
+_composites_lock = threading.Lock()
+
+# Directory of the composite manifests shared across processes (e.g. job workers), memory only if unset
+DEFAULT_COMPOSITE_DIR = os.environ.get('AEDES_COMPOSITE_DIR')
+
+# Earth Engine asset folder composites are materialized into (e.g. 'projects/<project>/assets/aedes'), none if unset
+DEFAULT_COMPOSITE_ASSET_ROOT = os.environ.get('AEDES_COMPOSITE_ASSET_ROOT')
+
+# Seconds between two status checks of a running asset export, and the export states that are final
+ASSET_POLL_SECONDS = 60
+FINAL_EXPORT_STATES = ['COMPLETED', 'FAILED', 'CANCELLED']
+
+def define_composite_source(catalog, bands=None, reducer='median', cloud_property='CLOUD_COVER', max_cloud=None)->dict:
+    """
+    Declares a composite source.
+    Input
+        catalog: Earth Engine image collection ID
+        bands: list of bands to keep, all bands if None
+        reducer: 'lowest_cloud' (single least cloudy scene), 'median' or 'mean'
+        cloud_property: image property sorted on by 'lowest_cloud' and filtered on by max_cloud
+        max_cloud: optional maximum of cloud_property, scenes above it are dropped
+    """
+
+    if reducer not in ['lowest_cloud', 'median', 'mean']:
+        raise ValueError(f"Unknown reducer '{reducer}', use 'lowest_cloud', 'median' or 'mean'.")
+
+    return {'catalog': catalog, 'bands': bands, 'reducer': reducer, 'cloud_property': cloud_property, 'max_cloud': max_cloud}
+
+# Sources used by get_satellite_measures_from_points
+COMPOSITE_SOURCES = {'landsat': define_composite_source('LANDSAT/LC08/C02/T1_L2',
+                                                        bands=['SR_B3', 'SR_B4', 'SR_B5', 'SR_B6', 'SR_QA_AEROSOL'],
+                                                        reducer='lowest_cloud'),
+                     'modis_lst': define_composite_source('MODIS/006/MOD11A1', bands=['LST_Day_1km']),
+                     'modis_fpar': define_composite_source('MODIS/006/MCD15A3H', bands=['Fpar']),
+                     'gldas': define_composite_source('NASA/GLDAS/V021/NOAH/G025/T3H',
+                                                      bands=['Rainf_f_tavg', 'Tair_f_inst', 'Psurf_f_inst', 'Qair_f_inst'])}
+
+def aoi_bounds(aoi_geojson)->list:
+    """
+    Bounds [min_lon, min_lat, max_lon, max_lat] of the AOI.
+    """
+
+    coordinates = [point for ring in aoi_geojson for point in ring]
+    longitudes = [point[0] for point in coordinates]
+    latitudes = [point[1] for point in coordinates]
+
+    return [min(longitudes), min(latitudes), max(longitudes), max(latitudes)]
+
+def snap_aoi_bounds(aoi_geojson, grid=0.1)->list:
+    """
+    Bounds [min_lon, min_lat, max_lon, max_lat] of the AOI snapped outward to a grid in degrees,
+    so that nearby or overlapping AOIs share the same composites.
+    """
+
+    min_lon, min_lat, max_lon, max_lat = aoi_bounds(aoi_geojson)
+
+    return [math.floor(min_lon / grid) * grid, math.floor(min_lat / grid) * grid,
+            math.ceil(max_lon / grid) * grid, math.ceil(max_lat / grid) * grid]
+
+def bounds_to_polygon(bounds)->list:
+    min_lon, min_lat, max_lon, max_lat = bounds
+
+    return [[[min_lon, min_lat], [max_lon, min_lat], [max_lon, max_lat], [min_lon, max_lat], [min_lon, min_lat]]]
+
+def composite_key(source, bounds, date_from, date_to)->str:
+    """
+    Composites are identified by their source definition, snapped bounds and date window.
+    """
+
+    description = {'source': source, 'bounds': [round(bound, 6) for bound in bounds], 'date_from': date_from, 'date_to': date_to}
+
+    return hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+def build_composite(source, region, date_from, date_to)->dict:
+    """
+    Builds the composite image of a source over a region and date window, without any round trip.
+    Returns a manifest entry with the image and its serialized expression, to rebuild it in another process.
+    """
+
+    collection = ee.ImageCollection(source['catalog']).filterBounds(region).filterDate(date_from, date_to)
+
+    if source['max_cloud'] is not None:
+        collection = collection.filter(ee.Filter.lt(source['cloud_property'], source['max_cloud']))
+
+    if source['reducer'] == 'lowest_cloud':
+        image = ee.Image(collection.sort(source['cloud_property']).first())
+        if source['bands'] is not None:
+            image = image.select(source['bands'])
+    else:
+        if source['bands'] is not None:
+            collection = collection.select(source['bands'])
+        image = ee.Image(collection.median() if source['reducer'] == 'median' else collection.mean())
+
+    return {'image': image, 'expression': image.serialize()}
+
+def export_composite_asset(image, bounds, asset_id, scale=1000)->str:
+    """
+    Starts materializing a composite into an Earth Engine asset, so that later requests read stored pixels
+    instead of recomputing the composite on the server. Returns the ID of the export task.
+    """
+
+    task = ee.batch.Export.image.toAsset(image=image,
+                                         description=f"aedes_composite_{asset_id.split('/')[-1]}",
+                                         assetId=asset_id,
+                                         region=bounds_to_polygon(bounds),
+                                         scale=scale,
+                                         maxPixels=1e10)
+    instrumented_call('earth_engine', 'composite_export', task.start)
+
+    return task.id
+
+def composite_export_state(task_id)->str:
+    """
+    State of an asset export task (e.g. 'READY', 'RUNNING', 'COMPLETED' or 'FAILED'), one round trip.
+    """
+
+    statuses = instrumented_call('earth_engine', 'composite_export_status', ee.data.getTaskStatus, task_id)
+
+    return statuses[0].get('state') if statuses else 'UNKNOWN'
+
+def load_composite_manifest(composite_dir, key)->dict:
+    """
+    Returns the manifest entry of a composite saved by any process, or None.
+    """
+
+    file_path = os.path.join(composite_dir, f'{key}.json')
+    if not os.path.exists(file_path):
+        return None
+
+    with open(file_path) as f:
+        manifest = json.load(f)
+
+    if manifest.get('asset_state') == 'COMPLETED':
+        image = ee.Image(manifest['asset_id'])
+    elif manifest.get('image_id') is not None:
+        # Manifests saved before expressions were kept for every reducer pin the resolved scene
+        image = ee.Image(manifest['image_id'])
+        if manifest['source']['bands'] is not None:
+            image = image.select(manifest['source']['bands'])
+    else:
+        image = ee.Image(ee.deserializer.fromJSON(manifest['expression']))
+
+    return {**manifest, 'image': image}
+
+def save_composite_manifest(composite_dir, key, manifest):
+    """
+    Writes the manifest entry of a composite (without the image) atomically.
+    """
+
+    os.makedirs(composite_dir, exist_ok=True)
+    file_path = os.path.join(composite_dir, f'{key}.json')
+
+    with open(f'{file_path}.tmp', 'w') as f:
+        json.dump({name: value for name, value in manifest.items() if name != 'image'}, f)
+    os.replace(f'{file_path}.tmp', file_path)
+
+def export_composite_raster(image, bounds, file_path, scale=1000)->str:
+    """
+    Downloads a composite over the bounds as a local GeoTIFF (e.g. for GIS tools).
+    Earth Engine limits direct downloads to about 32 MB, so keep bounds small or scale coarse.
+    """
+
+    url = instrumented_call('earth_engine', 'composite_download_url', image.getDownloadURL,
+                            {'region': bounds_to_polygon(bounds), 'scale': scale, 'format': 'GEO_TIFF'})
+
+    os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
+    with urllib.request.urlopen(url) as response, open(f'{file_path}.tmp', 'wb') as f:
+        f.write(response.read())
+    os.replace(f'{file_path}.tmp', file_path)
+
+    return file_path
+
+def get_composite(name,
+                  aoi_geojson,
+                  date_from='2021-11-01',
+                  date_to='2021-12-31',
+                  sources=COMPOSITE_SOURCES,
+                  composite_dir=None,
+                  grid=0.1,
+                  export_raster=False,
+                  scale=1000,
+                  asset_root=None):
+    """
+    Composite image of a registered source for an AOI and date window, built once per
+    (snapped AOI bounds, date window) and reused from memory, then from the manifests in composite_dir.
+    With asset_root, the composite is also materialized once into an Earth Engine asset, which every process
+    reads instead of recomputing the composite as soon as the export has completed.
+    A 'lowest_cloud' scene is picked against the AOI bounds themselves, as a scene that only overlaps the
+    snapped margin would leave the AOI without data, so it is only shared by AOIs with the same bounds.
+    Input
+        name: name of the source in sources
+        aoi_geojson: polygon coordinates of the area of interest
+        sources: dictionary of source names to define_composite_source definitions
+        composite_dir: directory of the manifests shared across processes, AEDES_COMPOSITE_DIR if None
+        grid: size in degrees of the grid the AOI bounds are snapped to
+        export_raster: boolean, also download the composite as a GeoTIFF to <composite_dir>/<key>.tif
+        scale: meters per pixel of the exported asset and raster
+        asset_root: Earth Engine asset folder to materialize composites into, AEDES_COMPOSITE_ASSET_ROOT if None
+    Returns
+        image: ee.Image composite
+    """
+
+    source = sources[name]
+    composite_dir = composite_dir or DEFAULT_COMPOSITE_DIR
+    asset_root = asset_root or DEFAULT_COMPOSITE_ASSET_ROOT
+    bounds = aoi_bounds(aoi_geojson) if source['reducer'] == 'lowest_cloud' else snap_aoi_bounds(aoi_geojson, grid=grid)
+    key = composite_key(source, bounds, date_from, date_to)
+
+    with _composites_lock:
+        manifest = _composites.get(key)
+
+    if manifest is None and composite_dir is not None:
+        manifest = load_composite_manifest(composite_dir, key)
+
+    record_cache('composite', manifest is not None)
+    is_changed = manifest is None
+
+    if manifest is None:
+        manifest = build_composite(source, ee.Geometry.Polygon(bounds_to_polygon(bounds)), date_from, date_to)
+        manifest.update({'name': name, 'source': source, 'bounds': bounds, 'date_from': date_from, 'date_to': date_to})
+
+    # Materialize once, then poll the export now and then until the asset can be read instead
+    if asset_root is not None and manifest.get('asset_id') is None:
+        manifest['asset_id'] = f'{asset_root}/{key}'
+        manifest['export_task_id'] = export_composite_asset(manifest['image'], bounds, manifest['asset_id'], scale=scale)
+        manifest['asset_state'] = 'READY'
+        manifest['asset_checked_at'] = time.time()
+        is_changed = True
+    elif (manifest.get('asset_id') is not None and manifest['asset_state'] not in FINAL_EXPORT_STATES
+          and time.time() - manifest.get('asset_checked_at', 0) > ASSET_POLL_SECONDS):
+        asset_state = composite_export_state(manifest['export_task_id'])
+        manifest['asset_checked_at'] = time.time()
+        if asset_state != manifest['asset_state']:
+            manifest['asset_state'] = asset_state
+            is_changed = True
+        if asset_state == 'COMPLETED':
+            manifest['image'] = ee.Image(manifest['asset_id'])
+
+    if export_raster and composite_dir is not None and manifest.get('raster_path') is None:
+        manifest['raster_path'] = export_composite_raster(manifest['image'], bounds,
+                                                          os.path.join(composite_dir, f'{key}.tif'), scale=scale)
+        is_changed = True
+
+    if is_changed and composite_dir is not None:
+        save_composite_manifest(composite_dir, key, manifest)
+
+    with _composites_lock:
+        _composites[key] = manifest
+
+    return manifest['image']
+
+def clear_composites():
+    """
+    Empties the in-process composite registry (manifests on disk are left untouched).
+    """
+
+    with _composites_lock:
+        _composites.clear()
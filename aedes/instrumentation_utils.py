@@ -0,0 +1,180 @@
+import os
+import json
+import time
+import bisect
+import functools
+import threading
+
+import pandas as pd
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+# Instrumentation is off unless enabled, in which case every wrapped call costs one flag check
+_enabled = os.environ.get('AEDES_INSTRUMENTATION', '0') == '1'
+_lock = threading.Lock()
+_calls = {}
+_caches = {}
+
+def enable_instrumentation():
+    """
+    Start recording timings, counts, bytes and cache hits.
+    """
+
+    global _enabled
+    _enabled = True
+
+def disable_instrumentation():
+    """
+    Stop recording, wrapped calls go straight through again.
+    """
+
+    global _enabled
+    _enabled = False
+
+def is_instrumentation_enabled()->bool:
+    return _enabled
+
+def reset_instrumentation():
+    """
+    Drop everything recorded so far.
+    """
+
+    with _lock:
+        _calls.clear()
+        _caches.clear()
+
+def response_size(value)->int:
+    """
+    Approximate size in bytes of a response as its JSON encoding (memory usage for dataframes).
+    """
+
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if hasattr(value, 'raw'):
+        value = value.raw
+
+    try:
+        return len(json.dumps(value, default=str))
+    except (TypeError, ValueError):
+        return 0
+
+def record_call(backend, operation, seconds, num_bytes=0, error=False):
+    """
+    Records one call of an operation on a backend (e.g. 'earth_engine', 'ndvi').
+    """
+
+    with _lock:
+        stats = _calls.setdefault((backend, operation), {'count': 0, 'errors': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                                                         'bytes': 0, 'buckets': [0] * (len(LATENCY_BUCKETS) + 1)})
+        stats['count'] += 1
+        stats['errors'] += int(error)
+        stats['seconds'] += seconds
+        stats['max_seconds'] = max(stats['max_seconds'], seconds)
+        stats['bytes'] += num_bytes
+        stats['buckets'][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+def record_cache(name, hit):
+    """
+    Records a hit or a miss of a named cache.
+    """
+
+    if not _enabled:
+        return
+
+    with _lock:
+        stats = _caches.setdefault(name, {'hits': 0, 'misses': 0})
+        stats['hits' if hit else 'misses'] += 1
+
+def instrumented_call(backend, operation, fn, *args, **kwargs):
+    """
+    Calls fn(*args, **kwargs), recording its latency and response size when instrumentation is enabled.
+    """
+
+    if not _enabled:
+        return fn(*args, **kwargs)
+
+    start = time.perf_counter()
+    try:
+        result = fn(*args, **kwargs)
+    except Exception:
+        record_call(backend, operation, time.perf_counter() - start, error=True)
+        raise
+
+    record_call(backend, operation, time.perf_counter() - start, response_size(result))
+
+    return result
+
+def instrumented(backend, operation):
+    """
+    Decorator version of instrumented_call.
+    """
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            return instrumented_call(backend, operation, fn, *args, **kwargs)
+        return wrapper
+
+    return decorator
+
+def get_instrumentation_report()->dict:
+    """
+    Returns everything recorded as a JSON-serializable dictionary with 'calls' and 'caches' lists.
+    """
+
+    with _lock:
+        calls = [{'backend': backend, 'operation': operation, 'count': stats['count'], 'errors': stats['errors'],
+                  'total_seconds': stats['seconds'], 'mean_seconds': stats['seconds'] / stats['count'],
+                  'max_seconds': stats['max_seconds'], 'bytes': stats['bytes'],
+                  'histogram': dict(zip([str(bound) for bound in LATENCY_BUCKETS] + ['+Inf'], stats['buckets']))}
+                 for (backend, operation), stats in sorted(_calls.items())]
+        caches = [{'cache': name, 'hits': stats['hits'], 'misses': stats['misses'],
+                   'hit_ratio': stats['hits'] / (stats['hits'] + stats['misses'])}
+                  for name, stats in sorted(_caches.items())]
+
+    return {'calls': calls, 'caches': caches}
+
+def get_instrumentation_report_df()->pd.DataFrame:
+    """
+    Per backend and operation call statistics as a dataframe, slowest total time first.
+    """
+
+    calls_df = pd.DataFrame(get_instrumentation_report()['calls'],
+                            columns=['backend', 'operation', 'count', 'errors', 'total_seconds',
+                                     'mean_seconds', 'max_seconds', 'bytes', 'histogram'])
+
+    return calls_df.drop(columns=['histogram']).sort_values('total_seconds', ascending=False).reset_index(drop=True)
+
+def to_prometheus_text()->str:
+    """
+    Everything recorded in the Prometheus text exposition format.
+    """
+
+    report = get_instrumentation_report()
+    lines = ['# HELP aedes_call_seconds Latency of remote calls and pipeline stages.',
+             '# TYPE aedes_call_seconds histogram']
+
+    for call in report['calls']:
+        labels = f'backend="{call["backend"]}",operation="{call["operation"]}"'
+        cumulative = 0
+        for bound, count in call['histogram'].items():
+            cumulative += count
+            lines.append(f'aedes_call_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'aedes_call_seconds_sum{{{labels}}} {call["total_seconds"]}')
+        lines.append(f'aedes_call_seconds_count{{{labels}}} {call["count"]}')
+
+    lines += ['# HELP aedes_call_errors_total Calls that raised an error.', '# TYPE aedes_call_errors_total counter']
+    lines += [f'aedes_call_errors_total{{backend="{call["backend"]}",operation="{call["operation"]}"}} {call["errors"]}'
+              for call in report['calls']]
+
+    lines += ['# HELP aedes_call_bytes_total Approximate bytes received.', '# TYPE aedes_call_bytes_total counter']
+    lines += [f'aedes_call_bytes_total{{backend="{call["backend"]}",operation="{call["operation"]}"}} {call["bytes"]}'
+              for call in report['calls']]
+
+    lines += ['# HELP aedes_cache_requests_total Cache lookups by result.', '# TYPE aedes_cache_requests_total counter']
+    for cache in report['caches']:
+        lines.append(f'aedes_cache_requests_total{{cache="{cache["cache"]}",result="hit"}} {cache["hits"]}')
+        lines.append(f'aedes_cache_requests_total{{cache="{cache["cache"]}",result="miss"}} {cache["misses"]}')
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,302 @@
+import os
+import json
+import time
+import shutil
+import socket
+import datetime
+import threading
+import hashlib
+import sqlite3
+import argparse
+import traceback
+import multiprocessing
+
+import pandas as pd
+
+from aedes.remote_sensing_utils import initialize
+from aedes.pipeline_utils import run_pipeline, hotspot_pipeline_stages
+
+def connect_job_store(db_path)->sqlite3.Connection:
+    """
+    Opens the SQLite job store, creating the jobs table if needed.
+    WAL mode lets the app poll job status while workers write.
+    """
+
+    connection = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            job_id TEXT PRIMARY KEY,
+            params TEXT NOT NULL,
+            status TEXT NOT NULL,
+            stage TEXT,
+            progress REAL DEFAULT 0,
+            worker TEXT,
+            error TEXT,
+            submitted_at REAL,
+            updated_at REAL
+        )""")
+
+    return connection
+
+def make_job_id(params)->str:
+    """
+    Identical parameters (AOI, sample points, dates, etc.) always map to the same job ID.
+    """
+
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+def submit_job(db_path, params)->str:
+    """
+    Queues a job and returns its ID. Identical jobs that are queued, running or done are not queued again,
+    failed ones are requeued.
+    """
+
+    job_id = make_job_id(params)
+    now = time.time()
+
+    connection = connect_job_store(db_path)
+    with connection:
+        connection.execute("INSERT OR IGNORE INTO jobs (job_id, params, status, submitted_at, updated_at) "
+                           "VALUES (?, ?, 'queued', ?, ?)", (job_id, json.dumps(params), now, now))
+        connection.execute("UPDATE jobs SET status='queued', error=NULL, progress=0, updated_at=? "
+                           "WHERE job_id=? AND status='failed'", (now, job_id))
+    connection.close()
+
+    return job_id
+
+def get_job(db_path, job_id)->dict:
+    """
+    Returns the status row of a job as a dictionary, or None if the job does not exist.
+    """
+
+    connection = connect_job_store(db_path)
+    row = connection.execute('SELECT * FROM jobs WHERE job_id=?', (job_id,)).fetchone()
+    connection.close()
+
+    if row is None:
+        return None
+
+    job = dict(row)
+    job['params'] = json.loads(job['params'])
+
+    return job
+
+def claim_next_job(db_path, worker_id)->dict:
+    """
+    Atomically moves the oldest queued job to running and returns it, or None if the queue is empty.
+    """
+
+    connection = connect_job_store(db_path)
+    connection.execute('BEGIN IMMEDIATE')
+    row = connection.execute("SELECT * FROM jobs WHERE status='queued' ORDER BY submitted_at LIMIT 1").fetchone()
+    if row is not None:
+        connection.execute("UPDATE jobs SET status='running', worker=?, updated_at=? WHERE job_id=?",
+                           (worker_id, time.time(), row['job_id']))
+    connection.execute('COMMIT')
+    connection.close()
+
+    if row is None:
+        return None
+
+    job = dict(row)
+    job['params'] = json.loads(job['params'])
+
+    return job
+
+def update_job(db_path, job_id, **fields):
+    """
+    Updates status columns of a job (status, stage, progress, error) and refreshes its heartbeat.
+    """
+
+    fields['updated_at'] = time.time()
+    assignments = ', '.join(f'{column}=?' for column in fields)
+
+    connection = connect_job_store(db_path)
+    with connection:
+        connection.execute(f'UPDATE jobs SET {assignments} WHERE job_id=?', list(fields.values()) + [job_id])
+    connection.close()
+
+def requeue_stale_jobs(db_path, stale_after=3600)->int:
+    """
+    Requeues running jobs whose worker has not reported progress for stale_after seconds (e.g. a killed worker).
+    Returns the number of requeued jobs.
+    """
+
+    connection = connect_job_store(db_path)
+    with connection:
+        cursor = connection.execute("UPDATE jobs SET status='queued', worker=NULL WHERE status='running' AND updated_at<?",
+                                    (time.time() - stale_after,))
+    connection.close()
+
+    return cursor.rowcount
+
+def expire_jobs(db_path, results_dir, max_age=7 * 24 * 3600)->int:
+    """
+    Deletes finished and failed jobs (and their results) last updated more than max_age seconds ago,
+    so that a later request for the same parameters runs again instead of being served stale results.
+    Returns the number of expired jobs.
+    """
+
+    connection = connect_job_store(db_path)
+    with connection:
+        rows = connection.execute("SELECT job_id FROM jobs WHERE status IN ('done', 'failed') AND updated_at<?",
+                                  (time.time() - max_age,)).fetchall()
+        connection.executemany('DELETE FROM jobs WHERE job_id=?', [(row['job_id'],) for row in rows])
+    connection.close()
+
+    for row in rows:
+        shutil.rmtree(os.path.join(results_dir, row['job_id']), ignore_errors=True)
+
+    return len(rows)
+
+def current_date_window(days=61, today=None)->tuple:
+    """
+    Date window (date_from, date_to) of the last days, ending on the Monday of the current week.
+    Putting it in the job parameters gives a new job every week, so weekly changing AOIs are not served stale.
+    """
+
+    today = today or datetime.date.today()
+    date_to = today - datetime.timedelta(days=today.weekday())
+    date_from = date_to - datetime.timedelta(days=days)
+
+    return date_from.isoformat(), date_to.isoformat()
+
+def save_job_result(results_dir, job_id, name, df):
+    """
+    Stores one result table of a job as a pickle under results_dir/job_id.
+    """
+
+    job_dir = os.path.join(results_dir, job_id)
+    os.makedirs(job_dir, exist_ok=True)
+
+    # Write to a temporary file first so that readers never load a partial table
+    file_path = os.path.join(job_dir, f'{name}.pkl')
+    df.to_pickle(f'{file_path}.tmp')
+    os.replace(f'{file_path}.tmp', file_path)
+
+def load_job_result(results_dir, job_id)->dict:
+    """
+    Loads every result table stored so far for a job as a dictionary of name to dataframe.
+    Tables published before the job finished (partial results) are included.
+    """
+
+    job_dir = os.path.join(results_dir, job_id)
+
+    if not os.path.isdir(job_dir):
+        return {}
+
+    return {file_name[:-len('.pkl')]: pd.read_pickle(os.path.join(job_dir, file_name))
+            for file_name in os.listdir(job_dir) if file_name.endswith('.pkl')}
+
+def run_hotspot_job(params, report_progress, cache_dir='aedes_stage_cache',
+                    composite_dir=os.environ.get('AEDES_COMPOSITE_DIR', 'aedes_composites')):
+    """
+    Hotspot detection for one AOI, the default job handler.
+    Stages run through the pipeline engine, so independent stages run concurrently and stage outputs
+    are reused from cache_dir by later jobs that share the same inputs (e.g. same AOI, other n_clusters).
+    Input
+        params: dictionary with aoi_geojson, sample_points, n_clusters and optionally date_from, date_to,
+                poi_amenities, num_pois and maxdist
+        report_progress: callable (stage, progress, **tables) used to publish status and partial result tables
+        cache_dir: directory of the stage output cache
+        composite_dir: directory of the satellite composite manifests, shared by every worker process
+    """
+
+    stage_kwargs = {key: params[key] for key in ['n_clusters', 'date_from', 'date_to',
+                                                 'poi_amenities', 'num_pois', 'maxdist'] if key in params}
+    stages = hotspot_pipeline_stages(composite_dir=composite_dir, **stage_kwargs)
+    done_stages = []
+
+    # Publish the clustered points as soon as they are ready so the map can be shown early
+    def on_stage_done(name, output):
+        done_stages.append(name)
+        tables = {'labeled_df': {'satellite_df': output}, 'hotspot_df': {'rev_geocode_df': output}}.get(name, {})
+        report_progress(f'Finished {name}', len(done_stages) / len(stages), **tables)
+
+    report_progress('Starting', 0.0)
+    run_pipeline(stages, {'aoi_geojson': params['aoi_geojson'], 'sample_points': params['sample_points']},
+                 cache_dir=cache_dir, on_stage_done=on_stage_done)
+
+    report_progress('Done', 1.0)
+
+def run_worker(db_path, results_dir, handler=run_hotspot_job, initializer=initialize,
+               poll_interval=1.0, stale_after=3600, heartbeat_interval=60, max_age=7 * 24 * 3600, max_jobs=None):
+    """
+    Worker loop: claims queued jobs one at a time and runs them with handler until max_jobs have run
+    (forever if None). initializer is called once before the first job (Earth Engine by default).
+    The running job's heartbeat is refreshed every heartbeat_interval seconds, even within a long stage.
+    While idle, jobs of workers silent for stale_after seconds are requeued and jobs older than max_age expire.
+    """
+
+    if heartbeat_interval >= stale_after:
+        raise ValueError('heartbeat_interval must be shorter than stale_after, or running jobs get requeued.')
+
+    worker_id = f'{socket.gethostname()}-{os.getpid()}'
+
+    if initializer is not None:
+        initializer()
+
+    jobs_run = 0
+    while max_jobs is None or jobs_run < max_jobs:
+        job = claim_next_job(db_path, worker_id)
+
+        if job is None:
+            requeue_stale_jobs(db_path, stale_after)
+            if max_age is not None:
+                expire_jobs(db_path, results_dir, max_age)
+            time.sleep(poll_interval)
+            continue
+
+        def report_progress(stage, progress, **tables):
+            for name, df in tables.items():
+                save_job_result(results_dir, job['job_id'], name, df)
+            update_job(db_path, job['job_id'], stage=stage, progress=progress)
+
+        # Stages can run for longer than stale_after, so keep the heartbeat going while the handler runs
+        stop_heartbeat = threading.Event()
+
+        def heartbeat(job_id):
+            while not stop_heartbeat.wait(heartbeat_interval):
+                update_job(db_path, job_id)
+
+        heartbeat_thread = threading.Thread(target=heartbeat, args=(job['job_id'],), daemon=True)
+        heartbeat_thread.start()
+
+        try:
+            handler(job['params'], report_progress)
+            update_job(db_path, job['job_id'], status='done')
+        except Exception:
+            update_job(db_path, job['job_id'], status='failed', error=traceback.format_exc())
+        finally:
+            stop_heartbeat.set()
+            heartbeat_thread.join()
+
+        jobs_run += 1
+
+def start_workers(db_path, results_dir, num_workers=2, **worker_kwargs)->list:
+    """
+    Starts num_workers daemon worker processes and returns them.
+    """
+
+    # Create the table before workers race to do it
+    connect_job_store(db_path).close()
+
+    workers = [multiprocessing.Process(target=run_worker, args=(db_path, results_dir),
+                                       kwargs=worker_kwargs, daemon=True)
+               for _ in range(num_workers)]
+    for worker in workers:
+        worker.start()
+
+    return workers
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run AEDES hotspot detection workers.')
+    parser.add_argument('--db', default='aedes_jobs.db', help='path to the SQLite job store')
+    parser.add_argument('--results', default='aedes_results', help='directory of the result store')
+    parser.add_argument('--workers', type=int, default=2, help='number of worker processes')
+    args = parser.parse_args()
+
+    for worker in start_workers(args.db, args.results, num_workers=args.workers):
+        worker.join()
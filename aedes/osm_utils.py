@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 import matplotlib
 import matplotlib.pyplot as plt
@@ -12,6 +13,8 @@ from geopy.geocoders import Nominatim
 from geopy.extra.rate_limiter import RateLimiter
 from shapely.geometry import box
 
+from aedes.instrumentation_utils import instrumented_call
+
 import warnings
 warnings.filterwarnings('ignore')
 
@@ -24,7 +27,7 @@ def initialize_OSM_network(aoi_geojson)->pandana.network.Network:
     aoi_csv = aoi_geojson[0][0][1], aoi_geojson[0][3][0], aoi_geojson[0][2][1], aoi_geojson[0][1][0]
 
     # Get network from geocsv
-    network = osm.pdna_network_from_bbox(*aoi_csv)
+    network = instrumented_call('overpass', 'network_from_bbox', osm.pdna_network_from_bbox, *aoi_csv)
     
     return network
 
@@ -34,7 +37,7 @@ def node_query(aoi_csv, amenity):
     """
     
     try:
-        query = osm.node_query(*aoi_csv, tags=f'"amenity"="{amenity}"')
+        query = instrumented_call('overpass', 'node_query', osm.node_query, *aoi_csv, tags=f'"amenity"="{amenity}"')
         return query
     except:
         pass
@@ -56,40 +59,54 @@ def get_OSM_network_data(network, df, aoi_geojson, poi_amenities, num_pois, maxd
         count_distance_df: dataframe of counts and distances of input df longlat to amenities POIs
     """
     
-    # Set AOI CSV from geojson
-    aoi_csv = aoi_geojson[0][0][1], aoi_geojson[0][3][0], aoi_geojson[0][2][1], aoi_geojson[0][1][0]
-    
     # get network ID per longlat pair of sampled points
     df['OSM_network_id'] = network.get_node_ids(df['longitude'], df['latitude'])
 
+    # Query the amenities once and set them on the network
+    amenities_df, accessibility = prepare_network_pois(network, aoi_geojson, poi_amenities, num_pois, maxdist)
+
+    # Counts and distances of the nearest POIs, one row per point
+    count_distance_df = network_poi_features(network, df, poi_amenities, accessibility, num_pois, maxdist,
+                                             node_ids=df['OSM_network_id'])
+
+    # Concatenate with final_df
+    final_df = pd.concat([df, count_distance_df.drop(columns=['OSM_network_id'])], axis=1)
+
+    if show_viz==True:
+        fig, ax = plt.subplots(figsize=(10,8))
+
+        plt.title(f'Distribution of {"_".join(poi_amenities)} Points of Interest ({maxdist/1000.}km radius)')
+        plt.scatter(network.nodes_df.x, network.nodes_df.y, 
+                    c=accessibility, s=1, cmap='Blues', 
+                    norm=matplotlib.colors.LogNorm())
+        cb = plt.colorbar()
+        plt.show()
+        
+    return final_df, amenities_df, count_distance_df
+
+def prepare_network_pois(network, aoi_geojson, poi_amenities, num_pois, maxdist):
+    """
+    Queries the amenities of the AOI, sets them as POIs on the network and counts them around every node.
+    Returns
+        amenities_df: dataframe on amenities from POIs
+        accessibility: series of the number of POIs within maxdist of each network node
+    """
+
+    # Set AOI CSV from geojson
+    aoi_csv = aoi_geojson[0][0][1], aoi_geojson[0][3][0], aoi_geojson[0][2][1], aoi_geojson[0][1][0]
+
     # Set category string
     category = f'all_{"_".join(poi_amenities)}'
 
     # query node details for each ammenity
     amenities_dict = {poi_amenities[i]:node_query(aoi_csv, poi_amenities[i]) for i in range(len(poi_amenities))}
-#     amenities_dict = {poi_amenities[i]:osm.node_query(*aoi_csv, tags=f'"amenity"="{poi_amenities[i]}"') for i in range(len(poi_amenities))}
 
     # Combine list of POIs into dataframe
     amenities_df = pd.concat(list(amenities_dict.values()))
     amenities_df = amenities_df[['lat', 'lon', 'amenity', 'name',]+[i for i in amenities_df.columns if 'addr' in i]]
 
     # Set POIs in network
-    network.set_pois(category = category,
-                         maxdist = maxdist,
-                         maxitems = num_pois,
-                         x_col = amenities_df.lon, 
-                         y_col = amenities_df.lat)
-
-    # Calculate distances
-    results = network.nearest_pois(distance = maxdist,
-                                   category = category,
-                                   num_pois = num_pois,
-                                  # include_poi_ids = True
-                                  )
-
-    # Get distance of n nearest POIs
-    distance_df = results.reset_index().rename(columns={'id':'OSM_network_id'}).merge(df[['OSM_network_id']])
-    distance_df.columns = ['OSM_network_id'] + [f'nearest_{"_".join(poi_amenities)}_{i}' for i in range(1, num_pois+1)]
+    set_network_pois(network, amenities_df, category, num_pois, maxdist)
 
     # Count of healthcare establishments around each node
     amenities_nodes = network.get_node_ids(amenities_df.lon, amenities_df.lat)
@@ -99,31 +116,102 @@ def get_OSM_network_data(network, df, aoi_geojson, poi_amenities, num_pois, maxd
                 name = category)
 
     # Count accessibility score for number of POIs within distance of each node
-    accessibility = network.aggregate(distance = maxdist,
+    accessibility = instrumented_call('pandana', 'aggregate', network.aggregate,
+                                      distance = maxdist,
                                       type = 'count',
                                       name = category)
 
+    return amenities_df, accessibility
+
+def network_poi_features(network, df, poi_amenities, accessibility, num_pois, maxdist, node_ids=None,
+                         poi_table=None)->pd.DataFrame:
+    """
+    Distances of the nearest POIs and count of POIs within maxdist of each point of df, indexed like df.
+    POIs must be set with prepare_network_pois. Pass poi_table (from nearest_poi_table) when calling this
+    for many chunks of points, so that the nearest POIs of the network are only queried once.
+    """
+
+    if node_ids is None:
+        node_ids = network.get_node_ids(df['longitude'], df['latitude'])
+
+    # Distances of the n nearest POIs of each point
+    distances, _, _ = nearest_poi_arrays(network, df, f'all_{"_".join(poi_amenities)}', num_pois, maxdist, node_ids=node_ids,
+                                         poi_table=poi_table)
+
+    count_distance_df = pd.DataFrame(distances, index=df.index,
+                                     columns=[f'nearest_{"_".join(poi_amenities)}_{i}' for i in range(1, num_pois+1)])
+    count_distance_df.insert(0, 'OSM_network_id', np.asarray(node_ids))
+
     # Count number of nearest POIs
-    count_df = accessibility.reset_index().rename(columns={'id':'OSM_network_id'}).merge(df[['OSM_network_id']])
-    count_df.columns = ['OSM_network_id', f'count_{"_".join(poi_amenities)}_within_{maxdist/1000.}km']
+    count_distance_df[f'count_{"_".join(poi_amenities)}_within_{maxdist/1000.}km'] = \
+        accessibility.to_numpy()[accessibility.index.get_indexer(node_ids)]
 
-    # Merge count and distance
-    count_distance_df = distance_df.merge(count_df)
+    return count_distance_df
 
-    # Merge with final_df 
-    final_df = df.merge(count_distance_df)
+def set_network_pois(network, amenities_df, category, num_pois, maxdist):
+    """
+    Sets the amenities as POIs of a category on the network, identified by their row position in amenities_df.
+    """
 
-    if show_viz==True:
-        fig, ax = plt.subplots(figsize=(10,8))
+    network.set_pois(category = category,
+                     maxdist = maxdist,
+                     maxitems = num_pois,
+                     x_col = pd.Series(amenities_df['lon'].to_numpy()),
+                     y_col = pd.Series(amenities_df['lat'].to_numpy()))
 
-        plt.title(f'Distribution of {"_".join(poi_amenities)} Points of Interest ({maxdist/1000.}km radius)')
-        plt.scatter(network.nodes_df.x, network.nodes_df.y, 
-                    c=accessibility, s=1, cmap='Blues', 
-                    norm=matplotlib.colors.LogNorm())
-        cb = plt.colorbar()
-        plt.show()
-        
-    return final_df, amenities_df, count_distance_df
+def nearest_poi_table(network, category, num_pois, maxdist)->pd.DataFrame:
+    """
+    Distances and IDs of the nearest POIs of every network node, indexed by node ID.
+    POIs must be set with set_network_pois.
+    """
+
+    return instrumented_call('pandana', 'nearest_pois', network.nearest_pois,
+                             distance = maxdist,
+                             category = category,
+                             num_pois = num_pois,
+                             include_poi_ids = True)
+
+def nearest_poi_arrays(network, df, category, num_pois, maxdist, amenities_df=None, attributes=['amenity', 'name'],
+                       node_ids=None, longitude='longitude', latitude='latitude', poi_table=None):
+    """
+    Nearest POIs of each point as columnar arrays aligned with the rows of df, without intermediate dataframes.
+    POIs must be set with set_network_pois.
+    Input
+        network: Pandana network
+        df: a dataframe of longitude and latitude
+        category: POI category set with set_network_pois
+        num_pois: integer, number of nearest POIs
+        maxdist: in meters, distances are capped at maxdist
+        amenities_df: optional dataframe of amenities given to set_network_pois, to look up POI attributes
+        attributes: list of amenities_df columns to look up
+        node_ids: optional network node IDs of the points, looked up from longitude and latitude if None
+        poi_table: optional nearest_poi_table of the network, queried over every node if None
+    Returns
+        distances: float32 array (len(df), num_pois), maxdist where there is no POI
+        poi_indices: int32 array (len(df), num_pois) of row positions in amenities_df, -1 where there is no POI
+        poi_attributes: dictionary of attribute name to object array (len(df), num_pois), None where there is no POI
+    """
+
+    if node_ids is None:
+        node_ids = network.get_node_ids(df[longitude], df[latitude])
+
+    results = poi_table if poi_table is not None else nearest_poi_table(network, category, num_pois, maxdist)
+
+    # Rows of the network nodes of each point
+    rows = results.index.get_indexer(node_ids)
+
+    distances = results[list(range(1, num_pois+1))].to_numpy(dtype=np.float32)[rows]
+    poi_indices = np.nan_to_num(results[[f'poi{i}' for i in range(1, num_pois+1)]].to_numpy(dtype=float)[rows],
+                                nan=-1).astype(np.int32)
+
+    poi_attributes = {}
+    if amenities_df is not None:
+        for attribute in attributes:
+            # One extra None slot at the end is picked by the -1 positions
+            values = np.append(amenities_df[attribute].to_numpy(dtype=object), None)
+            poi_attributes[attribute] = values[poi_indices]
+
+    return distances, poi_indices, poi_attributes
 
 def id_generator(size=6, chars=string.ascii_uppercase + string.digits):
     return ''.join(random.choice(chars) for _ in range(size))
@@ -137,7 +225,7 @@ def reverse_geocode(lat, long, user_agent_string='geogeopypy')->pd.DataFrame:
     coordinates = f"{lat}, {long}"
     
     rgeocode = RateLimiter(locator.reverse, min_delay_seconds=0.001)
-    loc_details = rgeocode(coordinates).raw
+    loc_details = instrumented_call('nominatim', 'reverse', rgeocode, coordinates).raw
     loc_details_df = pd.json_normalize(loc_details)
     return loc_details_df
 
@@ -151,7 +239,7 @@ def reverse_geocode_points(df, latitude='latitude', longitude='longitude')->pd.D
     id_str = id_generator()
     
     # reverse geocode points 
-    series = df[[latitude, longitude]].apply(lambda x: reverse_geocode(x[0], x[1], user_agent_string=id_str), axis=1)
+    series = df[[latitude, longitude]].apply(lambda x: reverse_geocode(x.iloc[0], x.iloc[1], user_agent_string=id_str), axis=1)
     points_rgeocode_df = pd.concat(series.tolist())
 
     # concatenate to original df
@@ -175,6 +263,7 @@ def reverse_geocode_center_of_geojson(aoi_geojson)->str:
     polygon = box(*bounds)
     
     # reverse geocode aoi_csv 
-    reverse_geocode = geolocator.reverse(", ".join([str(i) for i in [polygon.centroid.x, polygon.centroid.y]]))
+    reverse_geocode = instrumented_call('nominatim', 'reverse', geolocator.reverse,
+                                        ", ".join([str(i) for i in [polygon.centroid.x, polygon.centroid.y]]))
     
     return reverse_geocode.address
@@ -0,0 +1,552 @@
+import os
+import json
+import time
+import pickle
+import queue
+import hashlib
+import functools
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+import pandas as pd
+
+from aedes.remote_sensing_utils import generate_random_ee_points, df_to_ee_point_chunks, get_satellite_measures_from_points, get_info
+from aedes.osm_utils import initialize_OSM_network, get_OSM_network_data, reverse_geocode_points, prepare_network_pois, network_poi_features, nearest_poi_table
+from aedes.automl_utils import perform_clustering
+from aedes.instrumentation_utils import instrumented_call, record_cache
+from aedes.risk_report_utils import ADMIN_LEVELS
+
+# In-process stage outputs keyed by stage cache key, least recently used first. Bounded because job workers
+# are long-lived, persisted stages are still found in the disk cache once evicted.
+STAGE_CACHE_MAX_ENTRIES = int(os.environ.get('AEDES_STAGE_CACHE_ENTRIES', 32))
+_stage_cache = OrderedDict()
+_stage_cache_lock = threading.Lock()
+
+# Clients shared by every pipeline run of this process (e.g. OSM networks), least recently used first
+SHARED_RESOURCES_MAX_ENTRIES = int(os.environ.get('AEDES_SHARED_RESOURCES', 4))
+_shared_resources = OrderedDict()
+_shared_resources_lock = threading.Lock()
+
+# Geocoding columns kept by the streaming pipeline, so every chunk writes the same columns
+GEOCODE_COLUMNS = ['display_name'] + [f'address.{level}' for level in ADMIN_LEVELS]
+
+# Marks the end of a stream of chunks
+_END_OF_STREAM = object()
+
+def define_stage(name, func, inputs=[], params={}, persist=True, version=1):
+    """
+    Declares a pipeline stage.
+    Input
+        name: name of the stage output, used by other stages as an input name
+        func: callable taking the inputs and params as keyword arguments and returning the output
+        inputs: list of names of pipeline inputs or other stage outputs needed by func
+        params: dictionary of JSON-serializable keyword arguments passed to func
+        persist: boolean, whether the output is also pickled to the disk cache (disable for unpicklable outputs)
+        version: part of the cache key, bump it when func changes so that cached outputs are not reused
+    """
+
+    return {'name': name, 'func': func, 'inputs': list(inputs), 'params': dict(params), 'persist': persist,
+            'version': version}
+
+def hash_value(value)->str:
+    """
+    Content hash of a pipeline input.
+    """
+
+    if isinstance(value, pd.DataFrame):
+        content = pd.util.hash_pandas_object(value, index=True).values.tobytes() + str(list(value.columns)).encode()
+    else:
+        content = json.dumps(value, sort_keys=True, default=repr).encode()
+
+    return hashlib.sha1(content).hexdigest()
+
+def stage_cache_keys(stages, inputs)->dict:
+    """
+    Cache key of every stage, derived from its function, params and the keys of its inputs.
+    A changed input or param therefore only invalidates the stages downstream of it.
+    """
+
+    keys = {name: hash_value(value) for name, value in inputs.items()}
+    pending = list(stages)
+
+    while pending:
+        ready = [stage for stage in pending if all(name in keys for name in stage['inputs'])]
+
+        if not ready:
+            raise ValueError(f"Stages {[stage['name'] for stage in pending]} have missing or cyclic inputs.")
+
+        for stage in ready:
+            description = {'stage': stage['name'],
+                           'func': f"{stage['func'].__module__}.{stage['func'].__qualname__}",
+                           'version': stage['version'],
+                           'params': stage['params'],
+                           'inputs': {name: keys[name] for name in stage['inputs']}}
+            keys[stage['name']] = hashlib.sha1(json.dumps(description, sort_keys=True, default=repr).encode()).hexdigest()
+            pending.remove(stage)
+
+    return {stage['name']: keys[stage['name']] for stage in stages}
+
+def load_cached_stage(stage, key, cache_dir):
+    """
+    Returns (True, output) if the stage output is in the memory or disk cache, (False, None) otherwise.
+    """
+
+    with _stage_cache_lock:
+        if key in _stage_cache:
+            _stage_cache.move_to_end(key)
+            return True, _stage_cache[key]
+
+    if cache_dir is not None and stage['persist']:
+        file_path = os.path.join(cache_dir, f"{stage['name']}_{key}.pkl")
+        if os.path.exists(file_path):
+            with open(file_path, 'rb') as f:
+                output = pickle.load(f)
+            remember_stage_output(key, output)
+            return True, output
+
+    return False, None
+
+def store_cached_stage(stage, key, output, cache_dir):
+    """
+    Keeps a stage output in the memory cache and, if the stage persists, in the disk cache.
+    """
+
+    remember_stage_output(key, output)
+
+    if cache_dir is not None and stage['persist']:
+        os.makedirs(cache_dir, exist_ok=True)
+        file_path = os.path.join(cache_dir, f"{stage['name']}_{key}.pkl")
+        with open(f'{file_path}.tmp', 'wb') as f:
+            pickle.dump(output, f)
+        os.replace(f'{file_path}.tmp', file_path)
+
+def remember_stage_output(key, output):
+    """
+    Keeps a stage output in the memory cache, evicting the least recently used outputs beyond STAGE_CACHE_MAX_ENTRIES.
+    """
+
+    with _stage_cache_lock:
+        _stage_cache[key] = output
+        _stage_cache.move_to_end(key)
+        while len(_stage_cache) > STAGE_CACHE_MAX_ENTRIES:
+            _stage_cache.popitem(last=False)
+
+def clear_stage_cache():
+    """
+    Empties the in-process stage cache (the disk cache is left untouched).
+    """
+
+    with _stage_cache_lock:
+        _stage_cache.clear()
+
+def get_shared_resource(key, factory):
+    """
+    Returns the client held for key by this process, creating it with factory on first use.
+    Worker processes are long-lived, so clients such as OSM networks are built once and shared by every job
+    (Earth Engine is initialized once per worker by run_worker). Only SHARED_RESOURCES_MAX_ENTRIES are kept.
+    """
+
+    with _shared_resources_lock:
+        if key in _shared_resources:
+            _shared_resources.move_to_end(key)
+            record_cache('shared_resource', True)
+            return _shared_resources[key]
+
+    record_cache('shared_resource', False)
+    resource = factory()
+
+    with _shared_resources_lock:
+        _shared_resources[key] = resource
+        while len(_shared_resources) > SHARED_RESOURCES_MAX_ENTRIES:
+            _shared_resources.popitem(last=False)
+
+    return resource
+
+def clear_shared_resources():
+    """
+    Drops every client held by this process.
+    """
+
+    with _shared_resources_lock:
+        _shared_resources.clear()
+
+def run_pipeline(stages, inputs, cache_dir=None, max_workers=4, on_stage_done=None):
+    """
+    Input
+        stages: list of stages from define_stage
+        inputs: dictionary of pipeline input names to values
+        cache_dir: directory of the disk cache of stage outputs, memory cache only if None
+        max_workers: integer, maximum number of stages running concurrently
+        on_stage_done: optional callable (name, output) called as soon as each stage output is available
+    Returns
+        outputs: dictionary of the pipeline inputs and every stage output
+        run_report_df: dataframe of stage, status ('cached' or 'ran') and seconds
+    """
+
+    keys = stage_cache_keys(stages, inputs)
+    outputs = dict(inputs)
+    report = []
+
+    def run_stage(stage):
+        start = time.time()
+        output = instrumented_call('pipeline', stage['name'], stage['func'],
+                                   **{name: outputs[name] for name in stage['inputs']}, **stage['params'])
+        store_cached_stage(stage, keys[stage['name']], output, cache_dir)
+        return output, time.time() - start
+
+    pending = list(stages)
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            # Resolve cache hits and start every stage whose inputs are available
+            for stage in [stage for stage in pending if all(name in outputs for name in stage['inputs'])]:
+                pending.remove(stage)
+                is_cached, output = load_cached_stage(stage, keys[stage['name']], cache_dir)
+                record_cache('pipeline_stage', is_cached)
+                if is_cached:
+                    outputs[stage['name']] = output
+                    report.append({'stage': stage['name'], 'status': 'cached', 'seconds': 0.0})
+                    if on_stage_done is not None:
+                        on_stage_done(stage['name'], output)
+                else:
+                    running[executor.submit(run_stage, stage)] = stage
+
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                output, seconds = future.result()
+                outputs[stage['name']] = output
+                report.append({'stage': stage['name'], 'status': 'ran', 'seconds': seconds})
+                if on_stage_done is not None:
+                    on_stage_done(stage['name'], output)
+
+    run_report_df = pd.DataFrame(report, columns=['stage', 'status', 'seconds'])
+
+    return outputs, run_report_df
+
+def sample_points_stage(aoi_geojson, sample_points)->pd.DataFrame:
+    """
+    Samples random points in the AOI and returns their longitude and latitude.
+    """
+
+    points = generate_random_ee_points(aoi_geojson, sample_points=sample_points)
+    coordinates = [feature['geometry']['coordinates'] for feature in get_info(points, 'points')['features']]
+
+    return pd.DataFrame(coordinates, columns=['longitude', 'latitude'])
+
+def satellite_stage(points_df, aoi_geojson, **satellite_kwargs)->pd.DataFrame:
+    """
+    Satellite measures of the sampled points, without the Earth Engine geometries.
+    """
+
+    points = df_to_ee_point_chunks(points_df, longitude='longitude', latitude='latitude')
+    satellite_df = get_satellite_measures_from_points(points, aoi_geojson, **satellite_kwargs)
+
+    return satellite_df.drop(columns=['buffered_geometry'])
+
+def network_stage(aoi_geojson):
+    """
+    Pandana network of the AOI, shared by every run of this process that needs it.
+    """
+
+    return get_shared_resource(('network', hash_value(aoi_geojson)), lambda: initialize_OSM_network(aoi_geojson))
+
+def osm_stage(network, points_df, aoi_geojson, poi_amenities, num_pois, maxdist)->pd.DataFrame:
+    """
+    Count and distances of the nearest amenities, one row per sampled point.
+    """
+
+    _, _, count_distance_df = get_OSM_network_data(network, points_df[['longitude', 'latitude']].copy(),
+                                                   aoi_geojson, poi_amenities, num_pois, maxdist)
+
+    return count_distance_df.reset_index(drop=True)
+
+def geocode_stage(points_df)->pd.DataFrame:
+    """
+    Reverse geocoded addresses of the sampled points.
+    """
+
+    rev_geocode_df = reverse_geocode_points(points_df[['longitude', 'latitude']])
+
+    return rev_geocode_df.drop(columns=['longitude', 'latitude', 'index'], errors='ignore')
+
+def clustering_stage(satellite_df, n_clusters)->pd.DataFrame:
+    """
+    Satellite measures with KMeans cluster labels.
+    """
+
+    clustering_model = perform_clustering(satellite_df, n_clusters=n_clusters)
+    labeled_df = satellite_df.copy()
+    labeled_df['labels'] = pd.Series(clustering_model.labels_)
+
+    return labeled_df
+
+def merge_stage(labeled_df, geocode_df, osm_df=None)->pd.DataFrame:
+    """
+    Concatenates the per-point outputs of every stage column-wise.
+    """
+
+    frames = [labeled_df.reset_index(drop=True), geocode_df.reset_index(drop=True)]
+
+    if osm_df is not None:
+        frames.append(osm_df.reset_index(drop=True))
+
+    return pd.concat(frames, axis=1)
+
+def hotspot_pipeline_stages(n_clusters=3,
+                            date_from='2021-11-01',
+                            date_to='2021-12-31',
+                            poi_amenities=None,
+                            num_pois=5,
+                            maxdist=5000,
+                            composite_dir=None)->list:
+    """
+    Stages of the hotspot workflow. The satellite, geocoding and (if poi_amenities is given) OSM stages
+    only share the sampled points, so they run concurrently. composite_dir shares the satellite composites
+    across processes (see aedes.composite_utils).
+    Pipeline inputs are aoi_geojson and sample_points.
+    """
+
+    stages = [define_stage('points_df', sample_points_stage, inputs=['aoi_geojson', 'sample_points']),
+              define_stage('satellite_df', satellite_stage, inputs=['points_df', 'aoi_geojson'],
+                           params={'date_from': date_from, 'date_to': date_to, 'composite_dir': composite_dir}),
+              define_stage('geocode_df', geocode_stage, inputs=['points_df']),
+              define_stage('labeled_df', clustering_stage, inputs=['satellite_df'],
+                           params={'n_clusters': n_clusters})]
+
+    merge_inputs = ['labeled_df', 'geocode_df']
+
+    if poi_amenities is not None:
+        stages += [define_stage('network', network_stage, inputs=['aoi_geojson'], persist=False),
+                   define_stage('osm_df', osm_stage, inputs=['network', 'points_df', 'aoi_geojson'],
+                                params={'poi_amenities': poi_amenities, 'num_pois': num_pois, 'maxdist': maxdist})]
+        merge_inputs.append('osm_df')
+
+    stages.append(define_stage('hotspot_df', merge_stage, inputs=merge_inputs))
+
+    return stages
+
+def iter_point_chunks(points, chunk_size=1000):
+    """
+    Yields dataframes of at most chunk_size points from a dataframe, a CSV path or an iterable of dataframes
+    (each of which is split again, so that no chunk is larger than chunk_size).
+    """
+
+    if isinstance(points, pd.DataFrame):
+        for start in range(0, len(points), chunk_size):
+            yield points.iloc[start:start+chunk_size]
+    elif isinstance(points, str):
+        yield from pd.read_csv(points, chunksize=chunk_size)
+    else:
+        for points_df in points:
+            yield from iter_point_chunks(points_df, chunk_size=chunk_size)
+
+def satellite_chunk_stage(chunk_df, aoi_geojson, **satellite_kwargs)->pd.DataFrame:
+    """
+    Adds the satellite measures to a chunk of points.
+    """
+
+    satellite_df = satellite_stage(chunk_df, aoi_geojson, **satellite_kwargs)
+
+    # Align on the point IDs carried through Earth Engine
+    satellite_df = satellite_df.set_index('point_id').reindex(chunk_df.index)
+
+    return chunk_df.join(satellite_df.drop(columns=['geometry', 'longitude', 'latitude']))
+
+def osm_chunk_stage(chunk_df, network, poi_amenities, accessibility, poi_table, num_pois, maxdist)->pd.DataFrame:
+    """
+    Adds the nearest amenity distances and counts to a chunk of points, with POIs already set on the network
+    and the nearest POIs of every node already queried, so a chunk only looks up the rows of its nodes.
+    """
+
+    return chunk_df.join(network_poi_features(network, chunk_df, poi_amenities, accessibility, num_pois, maxdist,
+                                              poi_table=poi_table))
+
+def geocode_chunk_stage(chunk_df, geocode_columns=GEOCODE_COLUMNS)->pd.DataFrame:
+    """
+    Adds the reverse geocoded address columns to a chunk of points.
+    """
+
+    rev_geocode_df = geocode_stage(chunk_df).reindex(columns=geocode_columns)
+
+    return chunk_df.join(rev_geocode_df.set_index(chunk_df.index))
+
+def scoring_chunk_stage(chunk_df, model, features, score_col='score')->pd.DataFrame:
+    """
+    Adds the predictions of a fitted model to a chunk of points, NaN for points with missing features.
+    """
+
+    X = chunk_df[features]
+    is_complete = X.notna().all(axis=1).to_numpy()
+
+    scores = np.full(len(chunk_df), np.nan)
+    if is_complete.any():
+        scores[is_complete] = model.predict(X[is_complete])
+
+    return chunk_df.assign(**{score_col: scores})
+
+def _run_stream_stage(name, fn, in_queue, out_queue, stats, stop):
+    """
+    Applies fn to every chunk of in_queue and passes the result on to out_queue.
+    After an error, the error is passed on instead and the rest of the input is drained so upstream never blocks.
+    """
+
+    while True:
+        item = in_queue.get()
+
+        if item is _END_OF_STREAM:
+            out_queue.put(_END_OF_STREAM)
+            return
+
+        # Errors are passed on, chunks are dropped once the run is stopping
+        if isinstance(item, BaseException):
+            out_queue.put(item)
+            continue
+        if stop.is_set():
+            continue
+
+        start = time.time()
+        try:
+            output = instrumented_call('pipeline', name, fn, item)
+        except Exception as e:
+            stop.set()
+            out_queue.put(e)
+            continue
+
+        stats['chunks'] += 1
+        stats['rows'] += len(output)
+        stats['seconds'] += time.time() - start
+        out_queue.put(output)
+
+def run_streaming_pipeline(points,
+                           aoi_geojson,
+                           output_path,
+                           chunk_size=1000,
+                           queue_size=2,
+                           date_from='2021-11-01',
+                           date_to='2021-12-31',
+                           network=None,
+                           poi_amenities=None,
+                           num_pois=5,
+                           maxdist=5000,
+                           geocode=True,
+                           geocode_columns=GEOCODE_COLUMNS,
+                           model=None,
+                           features=None,
+                           score_col='score',
+                           composite_dir=None,
+                           id_col=None)->pd.DataFrame:
+    """
+    Streams points through the satellite, OSM, geocoding and scoring stages in chunks and appends
+    every finished chunk to a CSV. Each stage runs in its own thread and stages are connected by queues
+    of at most queue_size chunks, so a slow stage holds back the ones before it and memory is bounded
+    by chunk_size rather than by the number of points.
+    Input
+        points: dataframe, CSV path or iterable of dataframes with longitude and latitude
+        aoi_geojson: geojson of the area of interest
+        output_path: CSV file the results are written to (overwritten)
+        chunk_size: integer, number of points per chunk
+        queue_size: integer, maximum number of chunks waiting between two stages
+        network: optional Pandana network, built from the AOI if None and poi_amenities is given
+        poi_amenities: optional list of amenities, the OSM stage is skipped if None
+        geocode: boolean, whether to reverse geocode the points (one Nominatim request per point)
+        geocode_columns: list of geocoding columns to keep
+        model: optional fitted model (e.g. from perform_clustering or perform_classification) used for scoring
+        features: list of model features, the model's feature_names_in_ if None
+        score_col: name of the model prediction column
+        composite_dir: directory of the satellite composite manifests shared across processes
+        id_col: column identifying the points (e.g. a household ID), written as the first output column
+                so results can be joined back, the index of points is written as 'point_id' if None
+    Returns
+        run_report_df: dataframe of stage, chunks, rows and busy seconds
+    """
+
+    stages = [('satellite', functools.partial(satellite_chunk_stage, aoi_geojson=aoi_geojson,
+                                              date_from=date_from, date_to=date_to, composite_dir=composite_dir))]
+
+    if poi_amenities is not None:
+        # Amenities and the nearest POIs of every node are queried once for the whole run
+        network = network if network is not None else network_stage(aoi_geojson)
+        _, accessibility = prepare_network_pois(network, aoi_geojson, poi_amenities, num_pois, maxdist)
+        poi_table = nearest_poi_table(network, f'all_{"_".join(poi_amenities)}', num_pois, maxdist)
+        stages.append(('osm', functools.partial(osm_chunk_stage, network=network, poi_amenities=poi_amenities,
+                                                accessibility=accessibility, poi_table=poi_table,
+                                                num_pois=num_pois, maxdist=maxdist)))
+
+    if geocode:
+        stages.append(('geocode', functools.partial(geocode_chunk_stage, geocode_columns=geocode_columns)))
+
+    if model is not None:
+        features = list(features if features is not None else model.feature_names_in_)
+        stages.append(('scoring', functools.partial(scoring_chunk_stage, model=model, features=features,
+                                                    score_col=score_col)))
+
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    stats = {name: {'chunks': 0, 'rows': 0, 'seconds': 0.0} for name, _ in stages + [('write', None)]}
+    stop = threading.Event()
+
+    id_name = id_col or 'point_id'
+
+    # Stages align their outputs on a fresh index, the caller's IDs travel as the first column
+    def feed():
+        try:
+            for chunk_df in iter_point_chunks(points, chunk_size=chunk_size):
+                if stop.is_set():
+                    break
+                ids = chunk_df.index if id_col is None else chunk_df[id_col]
+                queues[0].put(pd.DataFrame({id_name: ids.to_numpy(),
+                                            'longitude': chunk_df['longitude'].to_numpy(),
+                                            'latitude': chunk_df['latitude'].to_numpy()}))
+        except Exception as e:
+            stop.set()
+            queues[0].put(e)
+        queues[0].put(_END_OF_STREAM)
+
+    threads = [threading.Thread(target=feed, daemon=True)]
+    threads += [threading.Thread(target=_run_stream_stage, args=(name, fn, queues[i], queues[i+1], stats[name], stop),
+                                 daemon=True)
+                for i, (name, fn) in enumerate(stages)]
+
+    for thread in threads:
+        thread.start()
+
+    # Write in this thread, keeping the columns of the first chunk for every chunk
+    if os.path.exists(output_path):
+        os.remove(output_path)
+
+    columns = None
+    error = None
+
+    while True:
+        item = queues[-1].get()
+
+        if item is _END_OF_STREAM:
+            break
+
+        if isinstance(item, BaseException):
+            error = error or item
+            continue
+
+        start = time.time()
+        columns = columns if columns is not None else list(item.columns)
+        item.reindex(columns=columns).to_csv(output_path, mode='a', header=stats['write']['chunks'] == 0, index=False)
+        stats['write']['chunks'] += 1
+        stats['write']['rows'] += len(item)
+        stats['write']['seconds'] += time.time() - start
+
+    for thread in threads:
+        thread.join()
+
+    if error is not None:
+        raise error
+
+    run_report_df = pd.DataFrame([{'stage': name, **stage_stats} for name, stage_stats in stats.items()],
+                                 columns=['stage', 'chunks', 'rows', 'seconds'])
+
+    return run_report_df
@@ -5,6 +5,9 @@ import ee
 
 import geopandas as gpd
 
+from aedes.instrumentation_utils import instrumented_call
+from aedes.composite_utils import COMPOSITE_SOURCES, get_composite
+
 def authenticate():
     """
     Authenticate connection to the server
@@ -19,6 +22,68 @@ def initialize():
     """
     ee.Initialize()
 
+def get_info(ee_object, operation):
+    """
+    Evaluates an Earth Engine object on the server (one round trip),
+    recorded under the 'earth_engine' backend when instrumentation is enabled.
+    """
+
+    return instrumented_call('earth_engine', operation, ee_object.getInfo)
+
+def ndvi_image(img):
+    """
+    NDVI band (Landsat 8 bands 5 and 4) of an image.
+    """
+
+    nir = img.select('SR_B5')
+    red = img.select('SR_B4')
+
+    return nir.subtract(red).divide(nir.add(red)).rename('NDVI')
+
+def ndbi_image(img):
+    """
+    NDBI band (Landsat 8 bands 6 and 5) of an image.
+    """
+
+    b5 = img.select('SR_B5')
+    b6 = img.select('SR_B6')
+
+    return b6.subtract(b5).divide(b6.add(b5)).rename('NDBI')
+
+def ndwi_image(img):
+    """
+    NDWI band (Landsat 8 bands 3 and 6) of an image.
+    """
+
+    b3 = img.select('SR_B3')
+    b6 = img.select('SR_B6')
+
+    return b3.subtract(b6).divide(b3.add(b6)).rename('NDWI')
+
+def ndmi_image(img):
+    """
+    NDMI band (Landsat 8 bands 5 and 6) of an image.
+    """
+
+    b5 = img.select('SR_B5')
+    b6 = img.select('SR_B6')
+
+    return b5.subtract(b6).divide(b5.add(b6)).rename('NDMI')
+
+def relative_humidity_image(img):
+    """
+    Relative humidity band of a GLDAS image, from air temperature, surface pressure and specific humidity.
+    """
+
+    return img.expression(
+      '0.263 * p * q * (exp(17.67 * (T - T0) / (T - 29.65))) ** -1', {
+        'T': img.select('Tair_f_inst'),
+        'T0': 273.16,
+        'p': img.select('Psurf_f_inst'),
+        'q': img.select('Qair_f_inst')
+      }
+    ).float().rename('relative_humidity')
+
 def meanNDVICollection(img, aoi)->float:
     """
     NDVI = (NIR – Red) / (NIR + Red)
@@ -29,19 +94,14 @@ def meanNDVICollection(img, aoi)->float:
     NDVI = 0.6 to 1.0 represent Dense vegetation or tropical rainforest
     """
     
-    nir = img.select('SR_B5')
-    red = img.select('SR_B4')
-    
-    ndviImage = nir.subtract(red).divide(nir.add(red)).rename('NDVI')
-    
     # Compute the mean of NDVI over the 'region'
-    ndviValue = ndviImage.reduceRegion(**{
-    'geometry': aoi.getInfo(),
+    ndviValue = ndvi_image(img).reduceRegion(**{
+    'geometry': get_info(aoi, 'buffer_geometry'),
     'reducer': ee.Reducer.mean(),
     'scale': 1000
     }).get('NDVI');  
 
-    return ndviValue.getInfo()
+    return get_info(ndviValue, 'ndvi')
 
 def meanNDBICollection(img, aoi)->float:
     """
@@ -51,19 +111,14 @@ def meanNDBICollection(img, aoi)->float:
    
     """
     
-    b5 = img.select('SR_B5')
-    b6 = img.select('SR_B6')
-    
-    ndbiImage = b6.subtract(b5).divide(b6.add(b5)).rename('NDBI')
-    
     # Compute the mean of NDBI over the 'region'
-    ndbiValue = ndbiImage.reduceRegion(**{
-    'geometry': aoi.getInfo(),
+    ndbiValue = ndbi_image(img).reduceRegion(**{
+    'geometry': get_info(aoi, 'buffer_geometry'),
     'reducer': ee.Reducer.mean(),
     'scale': 1000
     }).get('NDBI');  
 
-    return ndbiValue.getInfo()
+    return get_info(ndbiValue, 'ndbi')
 
 def meanNDWICollection(img, aoi)->float:
     """
@@ -74,19 +129,14 @@ def meanNDWICollection(img, aoi)->float:
     Generally, water bodies NDWI value is greater than 0.5.
     """
     
-    b3 = img.select('SR_B3')
-    b6 = img.select('SR_B6')
-    
-    ndwiImage = b3.subtract(b6).divide(b3.add(b6)).rename('NDWI')
-    
     # Compute the mean of NDWI over the 'region'
-    ndwiValue = ndwiImage.reduceRegion(**{
-    'geometry': aoi.getInfo(),
+    ndwiValue = ndwi_image(img).reduceRegion(**{
+    'geometry': get_info(aoi, 'buffer_geometry'),
     'reducer': ee.Reducer.mean(),
     'scale': 1000
     }).get('NDWI'); 
 
-    return ndwiValue.getInfo()
+    return get_info(ndwiValue, 'ndwi')
 
 def meanNDMICollection(img, aoi)->float:
     """
@@ -95,19 +145,14 @@ def meanNDMICollection(img, aoi)->float:
     In Landsat 8, NDMI = (Band 5 – Band 6) / (Band 5 + Band 6).
     """
     
-    b5 = img.select('SR_B5')
-    b6 = img.select('SR_B6')
-    
-    ndmiImage = b5.subtract(b6).divide(b5.add(b6)).rename('NDMI')
-    
     # Compute the mean of NDMI over the 'region'
-    ndmiValue = ndmiImage.reduceRegion(**{
-    'geometry': aoi.getInfo(),
+    ndmiValue = ndmi_image(img).reduceRegion(**{
+    'geometry': get_info(aoi, 'buffer_geometry'),
     'reducer': ee.Reducer.mean(),
     'scale': 1000
     }).get('NDMI'); 
     
-    return ndmiValue.getInfo()
+    return get_info(ndmiValue, 'ndmi')
 
 def meanfAPARCollection(img, aoi)->float:
     """
@@ -125,13 +170,13 @@ def meanfAPARCollection(img, aoi)->float:
     
     # Compute the mean of of precipitation over the 'region'
     faparValue = faparImage.reduceRegion(**{
-    'geometry': aoi.getInfo(),
+    'geometry': get_info(aoi, 'buffer_geometry'),
     'reducer': ee.Reducer.mean(),
     'scale': 1000
     }).get('fapar'); 
 
     try:
-        return faparValue.getInfo() * 0.001
+        return get_info(faparValue, 'fapar') * 0.001
     except:
         return 0
 
@@ -149,12 +194,12 @@ def meanAirQualityCollection(img, aoi)->float:
     
     # Compute the mean of aerosol (air quality index) over the 'region'
     aerosolValue = aerosolImage.reduceRegion(**{
-    'geometry': aoi.getInfo(),
+    'geometry': get_info(aoi, 'buffer_geometry'),
     'reducer': ee.Reducer.mean(),
     'scale': 1000
     }).get('aerosol'); 
 
-    return aerosolValue.getInfo()
+    return get_info(aerosolValue, 'aerosol')
 
 def meanSurfaceTemperatureCollection(img, aoi)->float:
     """
@@ -167,13 +212,13 @@ def meanSurfaceTemperatureCollection(img, aoi)->float:
     surftempImage = surftemp.rename('surface_temperature')
     
     surftempValue = surftempImage.reduceRegion(**{
-    'geometry': aoi.getInfo(),
+    'geometry': get_info(aoi, 'buffer_geometry'),
     'reducer': ee.Reducer.mean(),
     'scale': 1000
     }).get('surface_temperature');  # result of reduceRegion is always a dictionary, so get the element we want
 
     try:
-        return surftempValue.getInfo() * 0.02 - 273.15 # converting LST Digital Number to Deg Celsius
+        return get_info(surftempValue, 'surface_temperature') * 0.02 - 273.15 # converting LST Digital Number to Deg Celsius
     except:
         return None
 
@@ -191,12 +236,12 @@ def meanPrecipitationCollection(img, aoi)->float:
     
     # Compute the mean of of precipitation over the 'region'
     precipValue = precipImage.reduceRegion(**{
-    'geometry': aoi.getInfo(),
+    'geometry': get_info(aoi, 'buffer_geometry'),
     'reducer': ee.Reducer.mean(),
     'scale': 1000
     }).get('precipitation'); 
 
-    return precipValue.getInfo()
+    return get_info(precipValue, 'precipitation')
 
 def meanRelHumidityCollection(img, aoi)->float:
     """
@@ -206,33 +251,46 @@ def meanRelHumidityCollection(img, aoi)->float:
     Ranges from 0 to 100 (with estimation errors)
     """
     
-    relative_humidity = img.expression(
-      '0.263 * p * q * (exp(17.67 * (T - T0) / (T - 29.65))) ** -1', {
-        'T': img.select('Tair_f_inst'),
-        'T0': 273.16,
-        'p': img.select('Psurf_f_inst'),
-        'q': img.select('Qair_f_inst')
-      }
-    ).float().rename('relative_humidity')
-    
     # Compute the mean of relative humidity over the 'region'
-    relative_humidityValue = relative_humidity.reduceRegion(**{
-    'geometry': aoi.getInfo(),
+    relative_humidityValue = relative_humidity_image(img).reduceRegion(**{
+    'geometry': get_info(aoi, 'buffer_geometry'),
     'reducer': ee.Reducer.mean(),
     'scale': 1000
     }).get('relative_humidity'); 
 
-    return relative_humidityValue.getInfo()
+    return get_info(relative_humidityValue, 'relative_humidity')
 
 
-def df_to_ee_points(df, longitude='lon', latitude='lat'):
+def df_to_geojson_points(df, longitude='lon', latitude='lat', id_col=None)->list:
     """
-    Converts a dataframe of long lat to Earth Engine-readable FeatureCollection object.
+    Converts the long lat columns of a dataframe to a list of GeoJSON point features in one pass,
+    each carrying a 'point_id' property (values of id_col, or the dataframe index if None).
     """
-    
-    points = ee.FeatureCollection(df[[longitude, latitude]].apply(lambda x: ee.Geometry.Point(x[0], x[1]), axis=1).values.tolist())
-    
-    return points
+
+    coordinates = df[[longitude, latitude]].to_numpy(dtype=float).tolist()
+    point_ids = (df.index if id_col is None else df[id_col]).tolist()
+
+    return [{'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': coordinate}, 'properties': {'point_id': point_id}}
+            for coordinate, point_id in zip(coordinates, point_ids)]
+
+def df_to_ee_points(df, longitude='lon', latitude='lat', id_col=None):
+    """
+    Converts a dataframe of long lat to Earth Engine-readable FeatureCollection object,
+    each point carrying a 'point_id' property (values of id_col, or the dataframe index if None).
+    """
+
+    features = df_to_geojson_points(df, longitude=longitude, latitude=latitude, id_col=id_col)
+
+    return ee.FeatureCollection({'type': 'FeatureCollection', 'features': features})
+
+def df_to_ee_point_chunks(df, longitude='lon', latitude='lat', id_col=None, chunk_size=5000)->list:
+    """
+    Same as df_to_ee_points for large tables, split into a list of FeatureCollections of at most chunk_size points
+    to stay under the request payload and collection size limits. get_satellite_measures_from_points accepts the list.
+    """
+
+    return [df_to_ee_points(df.iloc[start:start+chunk_size], longitude=longitude, latitude=latitude, id_col=id_col)
+            for start in range(0, len(df), chunk_size)]
 
 def generate_random_ee_points(aoi_geojson, sample_points):
     """
@@ -248,82 +306,111 @@ def generate_random_ee_points(aoi_geojson, sample_points):
     
     return points
     
+# Measures added by get_satellite_measures_from_points, in order
+SATELLITE_MEASURES = ['ndvi', 'fapar', 'ndbi', 'ndwi', 'ndmi', 'aerosol', 'surface_temperature',
+                      'precipitation_rate', 'relative_humidity']
+
+def satellite_measures_image(sat_image, modis_sat_image, modis_fpar_sat_image, gldas_sat_image):
+    """
+    Stacks the measures of get_satellite_measures_from_points (before scale factors) as the bands of one image.
+    """
+
+    return (ndvi_image(sat_image).rename('ndvi')
+            .addBands(modis_fpar_sat_image.select('Fpar').rename('fapar'))
+            .addBands(ndbi_image(sat_image).rename('ndbi'))
+            .addBands(ndwi_image(sat_image).rename('ndwi'))
+            .addBands(ndmi_image(sat_image).rename('ndmi'))
+            .addBands(sat_image.select('SR_QA_AEROSOL').rename('aerosol'))
+            .addBands(modis_sat_image.select('LST_Day_1km').rename('surface_temperature'))
+            .addBands(gldas_sat_image.select('Rainf_f_tavg').rename('precipitation_rate'))
+            .addBands(relative_humidity_image(gldas_sat_image)))
+
 def get_satellite_measures_from_points(points,
                            aoi_geojson, 
                            landsat_catalog='LANDSAT/LC08/C02/T1_L2',
                            modis_catalog = "MODIS/006/MOD11A1",
                            gldas_catalog = "NASA/GLDAS/V021/NOAH/G025/T3H",
                            date_from='2021-11-01', 
-                           date_to='2021-12-31')->pd.DataFrame:
+                           date_to='2021-12-31',
+                           composite_sources=COMPOSITE_SOURCES,
+                           composite_dir=None)->pd.DataFrame:
     """
     From a bounding box geojson, get normalized difference indices at different sample points.
-    """
-    # Landsat catalog (for normalized difference indices)
-    landsat = ee.ImageCollection(landsat_catalog)
-    
-    # MODIS catalog (for surface temperature)
-    modis = ee.ImageCollection(modis_catalog)
-    
-    # GLDAS catalog (for precipitation)
-    gldas = ee.ImageCollection(gldas_catalog)
-    
-    # MODIS catalog (for fAPAR)
-    modis_fpar = ee.ImageCollection("MODIS/006/MCD15A3H")
-    
-    # setting the Area of Interest (AOI)
-    AOI = ee.Geometry.Polygon(aoi_geojson)
-
-    # filter area and date
-    landsat_AOI = landsat.filterBounds(AOI).filterDate(date_from, date_to)
-    
-    # Get satellite image with lowest cloud cover
-    sat_image = ee.Image(landsat_AOI.sort('CLOUD_COVER').first())
-    
-    # filter area and date for MODIS
-    modis_AOI = modis.filterBounds(AOI).filterDate(date_from, date_to)
-
-    # Get satellite image for MODIS
-    modis_sat_image = ee.Image(modis_AOI.median())
-    
-    # filter area and date for GLDAS
-    gldas_AOI = gldas.filterBounds(AOI).filterDate(date_from, date_to)
-
-    # Get satellite image for GLDAS
-    gldas_sat_image = ee.Image(gldas_AOI.median())
-    
-    # filter area and date for MODIS FAPAR
-    modis_fpar_AOI = modis_fpar.filterBounds(AOI).filterDate(date_from, date_to)
-
-    # Get satellite image for MODIS FAPAR
-    modis_fpar_sat_image = ee.Image(modis_fpar_AOI.median())
+    points can be a FeatureCollection or a list of FeatureCollections (chunks from df_to_ee_point_chunks),
+    in which case chunks are processed one at a time and concatenated.
+    Every measure of every point in a (chunk of) points is reduced in one reduceRegions call.
+    Composites come from the composite registry (see aedes.composite_utils), so they are only built
+    once per AOI tile and date window; composite_dir shares them across processes.
+    """
+
+    # Process chunked point tables one chunk at a time
+    if isinstance(points, (list, tuple)):
+        return pd.concat([get_satellite_measures_from_points(chunk, aoi_geojson,
+                                                             landsat_catalog=landsat_catalog,
+                                                             modis_catalog=modis_catalog,
+                                                             gldas_catalog=gldas_catalog,
+                                                             date_from=date_from,
+                                                             date_to=date_to,
+                                                             composite_sources=composite_sources,
+                                                             composite_dir=composite_dir) for chunk in points],
+                         ignore_index=True)
+
+    # The catalog arguments override the catalogs of the registered sources
+    sources = {**composite_sources,
+               'landsat': {**composite_sources['landsat'], 'catalog': landsat_catalog},
+               'modis_lst': {**composite_sources['modis_lst'], 'catalog': modis_catalog},
+               'gldas': {**composite_sources['gldas'], 'catalog': gldas_catalog}}
+
+    composite_fn = lambda name: get_composite(name, aoi_geojson, date_from=date_from, date_to=date_to,
+                                              sources=sources, composite_dir=composite_dir)
+
+    # Landsat image with lowest cloud cover (for normalized difference indices)
+    sat_image = composite_fn('landsat')
+
+    # MODIS median (for surface temperature)
+    modis_sat_image = composite_fn('modis_lst')
+
+    # GLDAS median (for precipitation and relative humidity)
+    gldas_sat_image = composite_fn('gldas')
+
+    # MODIS median (for fAPAR)
+    modis_fpar_sat_image = composite_fn('modis_fpar')
     
     # Function to get 1km patches of images from each point
     roi_with_buffer_fn = lambda geopoint: ee.Geometry.Point([geopoint.xy[0][0], geopoint.xy[1][0]]).buffer(1000)
     
     # Convert ee.geometry points to pandas dataframe and add 1km buffer around each point
-    points_df = gpd.GeoDataFrame.from_features(points.getInfo()["features"])
+    points_df = gpd.GeoDataFrame.from_features(get_info(points, "points")["features"])
     points_df['buffered_geometry'] = points_df['geometry'].apply(roi_with_buffer_fn)
 
     # Extract long lat
     points_df['longitude'] = points_df.geometry.apply(lambda g: g.x)
     points_df['latitude'] = points_df.geometry.apply(lambda g: g.y)
 
-    # Get all normalized difference indices
-    points_df['ndvi'] = points_df['buffered_geometry'].apply(lambda x: meanNDVICollection(sat_image, x))
-    points_df['fapar'] = points_df['buffered_geometry'].apply(lambda x: meanfAPARCollection(modis_fpar_sat_image, x))
-    points_df['ndbi'] = points_df['buffered_geometry'].apply(lambda x: meanNDBICollection(sat_image, x))
-    points_df['ndwi'] = points_df['buffered_geometry'].apply(lambda x: meanNDWICollection(sat_image, x))
-    points_df['ndmi'] = points_df['buffered_geometry'].apply(lambda x: meanNDMICollection(sat_image, x))
-    points_df['aerosol'] = points_df['buffered_geometry'].apply(lambda x: meanAirQualityCollection(sat_image, x))
-    points_df['surface_temperature'] = (points_df['buffered_geometry']
-                                        .apply(lambda x: meanSurfaceTemperatureCollection(modis_sat_image, x)))
-    points_df['precipitation_rate'] = (points_df['buffered_geometry']
-                                        .apply(lambda x: meanPrecipitationCollection(gldas_sat_image, x)))
-    points_df['relative_humidity'] = (points_df['buffered_geometry']
-                                        .apply(lambda x: meanRelHumidityCollection(gldas_sat_image, x)))
-    
+    # One band per measure, so that every patch is reduced in one request instead of one per point and measure
+    measures_image = satellite_measures_image(sat_image, modis_sat_image, modis_fpar_sat_image, gldas_sat_image)
+    patches = ee.FeatureCollection([ee.Feature(buffered_geometry, {'row': row})
+                                    for row, buffered_geometry in enumerate(points_df['buffered_geometry'])])
+    reduced = measures_image.reduceRegions(**{
+    'collection': patches,
+    'reducer': ee.Reducer.mean(),
+    'scale': 1000
+    })
+
+    # Patches without data (e.g. masked pixels) come back without the band
+    measures_df = (pd.DataFrame([feature['properties'] for feature in get_info(reduced, 'satellite_measures')['features']])
+                   .set_index('row').reindex(index=range(len(points_df)), columns=SATELLITE_MEASURES))
+    measures_df = measures_df.astype(float)
+
+    # Scale factors of the products (fAPAR falls back to 0 and LST is converted from Digital Number to Deg Celsius)
+    measures_df['fapar'] = (measures_df['fapar'] * 0.001).fillna(0)
+    measures_df['surface_temperature'] = measures_df['surface_temperature'] * 0.02 - 273.15
+
+    for measure in SATELLITE_MEASURES:
+        points_df[measure] = measures_df[measure].to_numpy()
+
     return points_df
-    
+
 def scale_factor(image):
   # scale factor for the MODIS MOD13Q1 product
 
@@ -375,10 +462,11 @@ def get_time_series_ndvi_evi(geojson, date_from='2018-01-01', date_to='2021-12-3
     
     return vegetation_df
 
-def visualize_on_map(points_df, ignore_labels=None, is_dark=True):
+def visualize_on_map(points_df, ignore_labels=None, is_dark=True, label_col='labels'):
     """
     Visualize the clusters on the map using Folium
     Themese for TileLayer: https://deparkes.co.uk/2016/06/10/folium-map-tiles/
+    label_col can point to any integer label column, e.g. 'hotspot_labels' from spatial_hotspots
     """
     
     # Plot clusters
@@ -390,9 +478,9 @@ def visualize_on_map(points_df, ignore_labels=None, is_dark=True):
     
     # if ignore_labels has input, remove them from unique labels
     if ignore_labels==None:
-        unique_labels = list(range(1, points_df['labels'].max()+1))
+        unique_labels = list(range(1, points_df[label_col].max()+1))
     else:
-        unique_labels = list(range(1, points_df['labels'].max()+1))
+        unique_labels = list(range(1, points_df[label_col].max()+1))
         unique_labels = [label for label in unique_labels if label not in ignore_labels]
     
     # set colors
@@ -404,10 +492,10 @@ def visualize_on_map(points_df, ignore_labels=None, is_dark=True):
               'darkblue', 'blue', 'lightblue']
     
     for j in range(len(unique_labels)):
-        for i in points_df[points_df['labels']==unique_labels[j]].index:
+        for i in points_df[points_df[label_col]==unique_labels[j]].index:
             folium.Marker(
             location = [points_df['latitude'].iloc[i], points_df['longitude'].iloc[i]],
-            popup = points_df.iloc[i]['labels'],
+            popup = points_df.iloc[i][label_col],
             icon = folium.Icon(color=colors[j])
             ).add_to(viz_map)
 
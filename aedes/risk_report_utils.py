@@ -0,0 +1,132 @@
+import numpy as np
+import pandas as pd
+
+# Nominatim address levels summarized by default, smallest first
+ADMIN_LEVELS = ['village', 'suburb', 'city', 'postcode', 'region']
+
+RISK_SUMMARY_COLUMNS = ['level', 'place', 'n_points', 'n_risky', 'score_sum', 'score_count']
+
+def place_names(series)->np.ndarray:
+    """
+    Address values as strings (None where missing), so that chunks read with different inferred dtypes
+    (e.g. postcodes as int in one chunk and as float in another) name the same place the same way.
+    """
+
+    values = series.dropna()
+
+    # Whole floats are only floats because of missing values in the chunk
+    if pd.api.types.is_float_dtype(values) and (values % 1 == 0).all():
+        values = values.astype('int64')
+
+    names = np.full(len(series), None, dtype=object)
+    names[series.notna().to_numpy()] = values.astype(str).to_numpy(dtype=object)
+
+    return names
+
+def partial_risk_summary(df, risky_col='risky', score_col=None, levels=ADMIN_LEVELS)->pd.DataFrame:
+    """
+    Additive per level and place totals of one table (or chunk) of reverse geocoded points,
+    computed in one vectorized pass over every level.
+    Input
+        df: dataframe with address.<level> columns, e.g. from reverse_geocode_points
+        risky_col: name of the boolean column of risky points
+        score_col: optional name of a model score column to average
+        levels: list of address levels, levels missing from df are skipped
+    Returns
+        partial_df: dataframe of level, place, n_points, n_risky, score_sum and score_count
+    """
+
+    levels = [level for level in levels if f'address.{level}' in df]
+
+    if not levels:
+        return pd.DataFrame(columns=RISK_SUMMARY_COLUMNS)
+
+    # Stack the address columns into one categorical of places, with the level of each as a code
+    places = pd.Categorical(np.concatenate([place_names(df[f'address.{level}']) for level in levels]))
+    if '' in places.categories:
+        places = places.remove_categories([''])
+    num_places = max(len(places.categories), 1)
+
+    # Points without an address at a level are not counted at that level
+    known = places.codes >= 0
+    keys = np.repeat(np.arange(len(levels)), len(df))[known] * num_places + places.codes[known]
+
+    risky = np.tile(df[risky_col].to_numpy(dtype=bool), len(levels))[known]
+    if score_col is not None:
+        scores = np.tile(df[score_col].to_numpy(dtype=float), len(levels))[known]
+    else:
+        scores = np.full(len(keys), np.nan)
+    has_score = ~np.isnan(scores)
+
+    # One bincount per total over the combined (level, place) key
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    partial_df = pd.DataFrame({'level': np.array(levels, dtype=object)[unique_keys // num_places],
+                               'place': np.asarray(places.categories, dtype=object)[unique_keys % num_places],
+                               'n_points': np.bincount(inverse, minlength=len(unique_keys)),
+                               'n_risky': np.bincount(inverse, weights=risky, minlength=len(unique_keys)).astype(int),
+                               'score_sum': np.bincount(inverse, weights=np.where(has_score, scores, 0.0),
+                                                        minlength=len(unique_keys)),
+                               'score_count': np.bincount(inverse, weights=has_score, minlength=len(unique_keys)).astype(int)},
+                              columns=RISK_SUMMARY_COLUMNS)
+
+    return partial_df
+
+def combine_risk_summaries(partial_dfs)->pd.DataFrame:
+    """
+    Adds up partial summaries (e.g. of several chunks) into one.
+    """
+
+    partial_dfs = [partial_df for partial_df in partial_dfs if len(partial_df)]
+
+    if not partial_dfs:
+        return pd.DataFrame(columns=RISK_SUMMARY_COLUMNS)
+
+    partial_df = pd.concat(partial_dfs, ignore_index=True)
+
+    return (partial_df.groupby(['level', 'place'], sort=False, as_index=False)
+            [['n_points', 'n_risky', 'score_sum', 'score_count']].sum())
+
+def finalize_risk_summary(partial_df, levels=ADMIN_LEVELS)->pd.DataFrame:
+    """
+    Turns additive totals into the risk summary, most risky places of each level first.
+    """
+
+    summary_df = partial_df[['level', 'place', 'n_points', 'n_risky']].copy()
+    summary_df['level'] = pd.Categorical(summary_df['level'], categories=levels)
+    summary_df['place'] = summary_df['place'].astype('category')
+    summary_df['risky_share'] = summary_df['n_risky'] / summary_df['n_points']
+    summary_df['mean_score'] = partial_df['score_sum'] / partial_df['score_count'].where(partial_df['score_count'] > 0)
+
+    summary_df = summary_df.sort_values(['level', 'n_risky', 'risky_share'], ascending=[True, False, False])
+
+    return summary_df.reset_index(drop=True)
+
+def summarize_risk_by_level(df, risky_col='risky', score_col=None, levels=ADMIN_LEVELS)->pd.DataFrame:
+    """
+    Risk summary of every admin level at once.
+    Input
+        df: dataframe with address.<level> columns, e.g. from reverse_geocode_points
+        risky_col: name of the boolean column of risky points
+        score_col: optional name of a model score column to average
+        levels: list of address levels, levels missing from df are skipped
+    Returns
+        summary_df: dataframe of level, place, n_points, n_risky, risky_share and mean_score (NaN without score_col)
+    """
+
+    return finalize_risk_summary(partial_risk_summary(df, risky_col=risky_col, score_col=score_col, levels=levels),
+                                 levels=levels)
+
+def summarize_risk_by_level_chunks(chunks, risky_col='risky', score_col=None, levels=ADMIN_LEVELS)->pd.DataFrame:
+    """
+    Same as summarize_risk_by_level for tables too large for memory, given an iterable of dataframes
+    (e.g. pd.read_csv(..., chunksize=100000), preferably with dtype=str for the address columns so that
+    postcodes keep their leading zeros). Only the running per place totals are kept.
+    """
+
+    running_df = pd.DataFrame(columns=RISK_SUMMARY_COLUMNS)
+
+    for chunk_df in chunks:
+        running_df = combine_risk_summaries([running_df, partial_risk_summary(chunk_df, risky_col=risky_col,
+                                                                              score_col=score_col, levels=levels)])
+
+    return finalize_risk_summary(running_df, levels=levels)
@@ -1,24 +1,216 @@
-import pandas as pd                        
+import os
+import re
+import time
+import random
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from pytrends.request import TrendReq
+from aedes.instrumentation_utils import instrumented_call
 pytrend = TrendReq()
 
 # PH-00 for Metro Manila, PH-14 for ARMM, etc. this is the reference: https://en.wikipedia.org/wiki/ISO_3166-2:PH
-geo_tag = "PH-00" 
+geo_tag = "PH-00"
 
-def get_search_trends(geo_tag):
-    # Instantiate dengue payload with one keyword
-    pytrend.build_payload(kw_list=['dengue'], geo=geo_tag)
+# All 17 regions of the Philippines as ISO 3166-2:PH codes
+PH_REGIONS = ["PH-00", "PH-01", "PH-02", "PH-03", "PH-05", "PH-06", "PH-07", "PH-08", "PH-09",
+              "PH-10", "PH-11", "PH-12", "PH-13", "PH-14", "PH-15", "PH-40", "PH-41"]
 
-    # Get all related queries (top and rising)
-    related_queries = pytrend.related_queries()
+def get_search_trends(geo_tag, client=None):
+    """
+    Pull the interest over time of 'dengue' and its top 4 related queries for one ISO 3166-2 geo tag.
+    """
+
+    # Use the module-level client unless one is provided
+    client = pytrend if client is None else client
 
-    # Update payload with top related queries
-    list_to_search = ['dengue'] + related_queries['dengue']['top'].head(4)['query'].values.flatten().tolist()
+    # Get dengue keyword with its top related queries
+    list_to_search = get_related_keywords(client, 'dengue', geo_tag)
 
     # Add in ther dengue-related payloads
-    pytrend.build_payload(kw_list=list_to_search, geo=geo_tag)
+    instrumented_call('google_trends', 'build_payload', client.build_payload, kw_list=list_to_search, geo=geo_tag)
 
     # Get historical dengue data
-    historical_search_df = pytrend.interest_over_time()
-    
+    historical_search_df = instrumented_call('google_trends', 'interest_over_time', client.interest_over_time)
+
     return historical_search_df
+
+def get_related_keywords(client, seed_keyword, geo_tag, num_related=4):
+    """
+    Returns the seed keyword followed by its top related queries within the geo tag.
+    """
+
+    # Instantiate payload with the seed keyword
+    instrumented_call('google_trends', 'build_payload', client.build_payload, kw_list=[seed_keyword], geo=geo_tag)
+
+    # Get all related queries (top and rising)
+    related_queries = instrumented_call('google_trends', 'related_queries', client.related_queries)
+    top_queries = related_queries[seed_keyword]['top']
+
+    # Regions with low search volume have no related queries
+    if top_queries is None:
+        return [seed_keyword]
+
+    return [seed_keyword] + top_queries.head(num_related)['query'].tolist()
+
+def call_with_backoff(fn, max_retries=5, base_delay=2.0, max_delay=120.0):
+    """
+    Calls fn, retrying with jittered exponential backoff when Google Trends rate-limits (HTTP 429) or errors out.
+    Raises the last error once max_retries is exhausted.
+    """
+
+    for attempt in range(max_retries + 1):
+        try:
+            return fn()
+        except Exception:
+            if attempt == max_retries:
+                raise
+            time.sleep(min(max_delay, base_delay * 2 ** attempt) * (0.5 + random.random()))
+
+def trends_store_path(store_path, geo_tag, seed_keyword):
+    """
+    Returns the CSV file in the local store holding history for a geo tag and seed keyword.
+    """
+
+    seed_slug = re.sub(r'[^0-9A-Za-z]+', '_', seed_keyword).strip('_')
+
+    return os.path.join(store_path, f'{geo_tag}_{seed_slug}.csv')
+
+def load_stored_trends(store_path, geo_tag, seed_keyword)->pd.DataFrame:
+    """
+    Loads stored interest over time for a geo tag and seed keyword, or None if nothing is stored yet.
+    """
+
+    file_path = trends_store_path(store_path, geo_tag, seed_keyword)
+
+    if not os.path.exists(file_path):
+        return None
+
+    return pd.read_csv(file_path, index_col='date', parse_dates=['date'])
+
+def save_stored_trends(trends_df, store_path, geo_tag, seed_keyword):
+    """
+    Writes interest over time for a geo tag and seed keyword into the local store.
+    """
+
+    os.makedirs(store_path, exist_ok=True)
+
+    # Write to a temporary file first so that concurrent readers never see a partial file
+    file_path = trends_store_path(store_path, geo_tag, seed_keyword)
+    trends_df.to_csv(f'{file_path}.tmp', index_label='date')
+    os.replace(f'{file_path}.tmp', file_path)
+
+def stitch_trends(history_df, recent_df)->pd.DataFrame:
+    """
+    Appends a freshly pulled trailing window onto stored history.
+    Google Trends normalizes every request to 0-100 within its own window, so the recent window
+    is rescaled per keyword by the ratio of both series over the weeks they overlap.
+    A recent window with finer (daily) resolution is first averaged onto the history's periods.
+    """
+
+    keywords = [col for col in history_df.columns if col != 'isPartial']
+
+    # Drop incomplete periods from history since they will be pulled again
+    if 'isPartial' in history_df.columns:
+        history_df = history_df[~history_df['isPartial'].astype(str).eq('True')]
+
+    # Align the recent window onto the periods of the stored history
+    history_step = history_df.index.to_series().diff().median()
+    recent_step = recent_df.index.to_series().diff().median()
+    if pd.notna(history_step) and pd.notna(recent_step) and recent_step < history_step:
+        recent_aligned_df = recent_df[keywords].resample(history_step, origin=history_df.index[0]).mean()
+        recent_aligned_df['isPartial'] = recent_aligned_df.index > recent_df.index[-1] - history_step
+    else:
+        recent_aligned_df = recent_df.copy()
+
+    # Rescale each keyword using the overlapping periods
+    overlap = history_df.index.intersection(recent_aligned_df.index)
+    for keyword in keywords:
+        recent_total = recent_aligned_df.loc[overlap, keyword].sum()
+        history_total = history_df.loc[overlap, keyword].sum()
+        if len(overlap) > 0 and recent_total > 0:
+            recent_aligned_df[keyword] = recent_aligned_df[keyword] * (history_total / recent_total)
+
+    # Keep stored history and append only the periods after it
+    new_periods_df = recent_aligned_df[recent_aligned_df.index > history_df.index[-1]]
+    stitched_df = pd.concat([history_df, new_periods_df[history_df.columns]])
+
+    return stitched_df
+
+def refresh_region_trends(client, geo_tag, seed_keyword, store_path,
+                          full_timeframe='today 5-y',
+                          overlap_weeks=8,
+                          num_related=4,
+                          max_retries=5,
+                          base_delay=2.0)->pd.DataFrame:
+    """
+    Brings the stored history for one geo tag and seed keyword up to date.
+    The first pull discovers related keywords and downloads full_timeframe (2 requests),
+    subsequent pulls reuse the stored keywords and only download the trailing window
+    from overlap_weeks before the last stored period (1 request).
+    """
+
+    history_df = load_stored_trends(store_path, geo_tag, seed_keyword)
+
+    if history_df is None or history_df.empty:
+        # Discover the related keywords and pull the full history
+        kw_list = call_with_backoff(lambda: get_related_keywords(client, seed_keyword, geo_tag, num_related),
+                                    max_retries=max_retries, base_delay=base_delay)
+        timeframe = full_timeframe
+    else:
+        # Reuse stored keywords and pull only the trailing window
+        kw_list = [col for col in history_df.columns if col != 'isPartial']
+        window_start = history_df.index[-1] - pd.Timedelta(weeks=overlap_weeks)
+        timeframe = f"{window_start:%Y-%m-%d} {pd.Timestamp.today():%Y-%m-%d}"
+
+    def pull():
+        instrumented_call('google_trends', 'build_payload', client.build_payload, kw_list=kw_list, geo=geo_tag,
+                          timeframe=timeframe)
+        return instrumented_call('google_trends', 'interest_over_time', client.interest_over_time)
+
+    pulled_df = call_with_backoff(pull, max_retries=max_retries, base_delay=base_delay)
+
+    # Nothing returned means no new data, keep history as is
+    if pulled_df is None or pulled_df.empty:
+        return history_df
+
+    pulled_df.index.name = 'date'
+
+    if history_df is None or history_df.empty:
+        trends_df = pulled_df
+    else:
+        trends_df = stitch_trends(history_df, pulled_df)
+
+    save_stored_trends(trends_df, store_path, geo_tag, seed_keyword)
+
+    return trends_df
+
+def collect_search_trends(geo_tags=PH_REGIONS,
+                          seed_keywords=['dengue'],
+                          store_path='search_trends',
+                          max_workers=2,
+                          client_factory=TrendReq,
+                          **refresh_kwargs)->dict:
+    """
+    Input
+        geo_tags: list of ISO 3166-2 codes, all 17 Philippine regions by default
+        seed_keywords: list of seed keywords, each expanded with its top related queries on first pull
+        store_path: directory of the local store where per-region histories are kept as CSV
+        max_workers: integer, number of regions pulled concurrently (keep low to avoid rate limits)
+        client_factory: callable returning a pytrends-like client, one client is created per worker task
+        refresh_kwargs: passed to refresh_region_trends (full_timeframe, overlap_weeks, max_retries, etc.)
+    Returns
+        trends_dict: dictionary of (geo_tag, seed_keyword) to interest over time dataframe
+    """
+
+    jobs = [(tag, seed) for tag in geo_tags for seed in seed_keywords]
+
+    # pytrends clients hold session state, so each task gets its own
+    def run(job):
+        return refresh_region_trends(client_factory(), job[0], job[1], store_path, **refresh_kwargs)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(run, jobs))
+
+    trends_dict = dict(zip(jobs, results))
+
+    return trends_dict
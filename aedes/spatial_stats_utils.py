@@ -0,0 +1,193 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse as sparse
+from scipy.spatial import cKDTree
+from scipy.stats import norm
+from joblib import Parallel, delayed
+
+# Gi* z-score thresholds of the 90%, 95% and 99% confidence hotspot labels
+GI_STAR_CONFIDENCE_Z = [1.645, 1.96, 2.576]
+
+LISA_QUADRANTS = {1: 'HH', 2: 'LH', 3: 'LL', 4: 'HL'}
+
+def project_to_meters(df, longitude='longitude', latitude='latitude')->np.ndarray:
+    """
+    Equirectangular projection of long lat to meters around the mean latitude,
+    accurate enough for neighbourhoods of a few kilometers.
+    """
+
+    lat0 = np.radians(df[latitude].mean())
+    x = np.radians(df[longitude].to_numpy(dtype=float)) * np.cos(lat0) * 6371000.0
+    y = np.radians(df[latitude].to_numpy(dtype=float)) * 6371000.0
+
+    return np.column_stack([x, y])
+
+def spatial_weights(df, k=8, distance_band=None, longitude='longitude', latitude='latitude')->sparse.csr_matrix:
+    """
+    Binary sparse spatial weights (without self-neighbours) built with a KD-tree.
+    Input
+        df: dataframe of longitude and latitude
+        k: integer, number of nearest neighbours (used when distance_band is None), needs more than k+1 points
+        distance_band: in meters, neighbours are all points within this distance
+    Returns
+        weights: n x n scipy CSR matrix
+    """
+
+    coordinates = project_to_meters(df, longitude=longitude, latitude=latitude)
+    n = len(coordinates)
+    tree = cKDTree(coordinates)
+
+    if distance_band is None:
+        if n <= k + 1:
+            raise ValueError(f'{n} points are too few for k={k} neighbours, Gi* needs more than k+1 points.')
+
+        # Nearest neighbours, dropping each point itself by index since duplicate coordinates
+        # can come before it in the query results
+        _, neighbours = tree.query(coordinates, k=k+1)
+        is_other = neighbours != np.arange(n)[:, None]
+        is_kept = is_other & (np.cumsum(is_other, axis=1) <= k)
+        rows = np.repeat(np.arange(n), k)
+        cols = neighbours[is_kept]
+    else:
+        pairs = tree.query_pairs(distance_band, output_type='ndarray')
+        rows = np.concatenate([pairs[:, 0], pairs[:, 1]])
+        cols = np.concatenate([pairs[:, 1], pairs[:, 0]])
+
+    weights = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(n, n))
+
+    return weights
+
+def getis_ord_gi_star(values, weights)->np.ndarray:
+    """
+    Getis-Ord Gi* z-score of every point, with each point included in its own neighbourhood.
+    """
+
+    x = np.asarray(values, dtype=float)
+    n = len(x)
+
+    weights_star = (weights + sparse.identity(n, format='csr')).tocsr()
+    weight_sums = np.asarray(weights_star.sum(axis=1)).ravel()
+    squared_weight_sums = np.asarray(weights_star.multiply(weights_star).sum(axis=1)).ravel()
+
+    x_mean = x.mean()
+    s = np.sqrt((x ** 2).mean() - x_mean ** 2)
+
+    numerator = weights_star @ x - x_mean * weight_sums
+    denominator = s * np.sqrt((n * squared_weight_sums - weight_sums ** 2) / (n - 1))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z_scores = numerator / denominator
+
+    return z_scores
+
+def _permuted_local_morans_i(z, m2, rows, neighbour_weights, permutations, seed)->np.ndarray:
+    """
+    Local Moran's I of rows under conditional randomization: each row keeps its own value while its
+    neighbours are drawn at random from all other points (with replacement, negligible when n >> k).
+    Returns an array of shape (len(rows), permutations).
+    """
+
+    rng = np.random.default_rng(seed)
+    n = len(z)
+
+    # Draw from n - 1 positions and shift draws at or past the row itself to skip it
+    draws = rng.integers(0, n - 1, size=(len(rows), permutations, neighbour_weights.shape[1]), dtype=np.int32)
+    draws += draws >= rows[:, None, None]
+
+    permuted_lags = (z[draws] * neighbour_weights[:, None, :]).sum(axis=2)
+
+    return z[rows, None] / m2 * permuted_lags
+
+def local_morans_i(values, weights, permutations=999, n_jobs=-1, chunk_size=500, seed=42):
+    """
+    Local Moran's I with row-standardized weights and conditional permutation inference,
+    with permutations run in parallel over chunks of points.
+    Returns
+        local_i: array of local Moran's I
+        p_values: array of pseudo p-values (folded, as in PySAL)
+        quadrants: array of LISA quadrants (1 HH, 2 LH, 3 LL, 4 HL)
+    """
+
+    x = np.asarray(values, dtype=float)
+    n = len(x)
+
+    # Row-standardize
+    row_sums = np.asarray(weights.sum(axis=1)).ravel()
+    row_standardized = sparse.diags(np.divide(1.0, row_sums, out=np.zeros(n), where=row_sums > 0)) @ weights
+    row_standardized = row_standardized.tocsr()
+
+    z = x - x.mean()
+    m2 = (z ** 2).sum() / n
+    lag = row_standardized @ z
+    local_i = z / m2 * lag
+
+    # Points sharing a neighbour count are permuted together as dense (rows, k) weight blocks
+    cardinalities = np.diff(row_standardized.indptr)
+    tasks = []
+    for cardinality in np.unique(cardinalities[cardinalities > 0]):
+        group_rows = np.flatnonzero(cardinalities == cardinality)
+        for start in range(0, len(group_rows), chunk_size):
+            rows = group_rows[start:start+chunk_size]
+            neighbour_weights = np.vstack([row_standardized.data[row_standardized.indptr[row]:row_standardized.indptr[row+1]]
+                                           for row in rows])
+            tasks.append((rows, neighbour_weights))
+
+    permuted = Parallel(n_jobs=n_jobs)(delayed(_permuted_local_morans_i)(z, m2, rows, neighbour_weights, permutations, seed + i)
+                                       for i, (rows, neighbour_weights) in enumerate(tasks))
+
+    p_values = np.ones(n)
+    for (rows, _), permuted_i in zip(tasks, permuted):
+        larger = (permuted_i >= local_i[rows, None]).sum(axis=1)
+        larger = np.where(permutations - larger < larger, permutations - larger, larger)
+        p_values[rows] = (larger + 1.0) / (permutations + 1.0)
+
+    quadrants = np.select([(z > 0) & (lag > 0), (z <= 0) & (lag > 0), (z <= 0) & (lag <= 0)], [1, 2, 3], default=4)
+
+    return local_i, p_values, quadrants
+
+def spatial_hotspots(df, column,
+                     k=8,
+                     distance_band=None,
+                     permutations=999,
+                     alpha=0.05,
+                     n_jobs=-1,
+                     longitude='longitude',
+                     latitude='latitude')->pd.DataFrame:
+    """
+    Input
+        df: dataframe of longitude, latitude and the column to test (a feature or a model score)
+        column: name of the column whose high values define hotspots
+        k: integer, number of nearest neighbours (used when distance_band is None), needs more than k+1 points
+        distance_band: in meters, neighbours are all points within this distance
+        permutations: integer, number of permutations for local Moran's I inference
+        alpha: significance level of the LISA clusters
+        n_jobs: integer, number of cores for the permutations (-1 for all)
+    Returns
+        hotspots_df: dataframe indexed like df with
+            gi_star_z, gi_star_p: Gi* z-score and two-sided p-value
+            hotspot_labels: 0 not a hotspot, 1/2/3 hotspot at 90/95/99% confidence (renders with visualize_on_map)
+            local_morans_i, local_morans_p: local Moran's I and its pseudo p-value
+            lisa_cluster: 'HH', 'LH', 'LL', 'HL' for significant points, 'ns' otherwise
+    """
+
+    # Points without a value cannot be tested
+    valid_df = df[[longitude, latitude, column]].dropna()
+
+    weights = spatial_weights(valid_df, k=k, distance_band=distance_band, longitude=longitude, latitude=latitude)
+
+    gi_star_z = getis_ord_gi_star(valid_df[column], weights)
+    local_i, local_p, quadrants = local_morans_i(valid_df[column], weights, permutations=permutations, n_jobs=n_jobs)
+
+    hotspots_df = pd.DataFrame({'gi_star_z': gi_star_z,
+                                'gi_star_p': 2 * norm.sf(np.abs(gi_star_z)),
+                                'hotspot_labels': np.searchsorted(GI_STAR_CONFIDENCE_Z, np.nan_to_num(gi_star_z), side='right'),
+                                'local_morans_i': local_i,
+                                'local_morans_p': local_p,
+                                'lisa_cluster': np.where(local_p <= alpha, pd.Series(quadrants).map(LISA_QUADRANTS), 'ns')},
+                               index=valid_df.index)
+
+    hotspots_df = hotspots_df.reindex(df.index)
+    hotspots_df['hotspot_labels'] = hotspots_df['hotspot_labels'].fillna(0).astype(int)
+    hotspots_df['lisa_cluster'] = hotspots_df['lisa_cluster'].fillna('ns')
+
+    return hotspots_df
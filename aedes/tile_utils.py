@@ -0,0 +1,277 @@
+import os
+import json
+import time
+import numpy as np
+import pandas as pd
+
+from aedes.remote_sensing_utils import generate_random_ee_points, get_satellite_measures_from_points
+from aedes.osm_utils import reverse_geocode_points
+from aedes.spatial_stats_utils import spatial_hotspots
+from aedes.risk_report_utils import ADMIN_LEVELS
+
+# Columns of the precomputed points kept for the risk summaries of covered AOIs
+HOTSPOT_POINT_COLUMNS = ['longitude', 'latitude', 'hotspot_labels', 'gi_star_z', 'display_name'] + \
+                        [f'address.{level}' for level in ADMIN_LEVELS]
+
+def lonlat_to_tile(longitude, latitude, zoom):
+    """
+    Converts arrays of longitude and latitude to web map (slippy map) tile x, y indices at a zoom level.
+    """
+
+    lat_rad = np.radians(np.asarray(latitude, dtype=float))
+    n = 2 ** zoom
+
+    x = np.floor((np.asarray(longitude, dtype=float) + 180.0) / 360.0 * n)
+    y = np.floor((1.0 - np.arcsinh(np.tan(lat_rad)) / np.pi) / 2.0 * n)
+
+    return np.clip(x, 0, n - 1).astype(np.int32), np.clip(y, 0, n - 1).astype(np.int32)
+
+def tile_to_lonlat(x, y, zoom):
+    """
+    Converts arrays of tile x, y indices at a zoom level to the longitude and latitude of the tile centers.
+    """
+
+    n = 2 ** zoom
+
+    longitude = (np.asarray(x) + 0.5) / n * 360.0 - 180.0
+    latitude = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (np.asarray(y) + 0.5) / n))))
+
+    return longitude, latitude
+
+def aggregate_tiles(tiles_df, label_columns, feature_columns)->pd.DataFrame:
+    """
+    Aggregates tile rows sharing x, y by summing counts and weighting feature means
+    by the number of non-missing values behind them (kept in <feature>_count columns).
+    """
+
+    count_columns = [f'{feature}_count' for feature in feature_columns]
+
+    # Missing feature means carry no weight, so they neither count nor pull the mean toward 0
+    weighted_df = tiles_df[['x', 'y', 'count', 'risky_count'] + label_columns + count_columns].copy()
+    for feature, count_column in zip(feature_columns, count_columns):
+        weighted_df[feature] = tiles_df[feature].fillna(0) * tiles_df[count_column]
+
+    grouped_df = weighted_df.groupby(['x', 'y'], sort=False).sum().reset_index()
+    for feature, count_column in zip(feature_columns, count_columns):
+        grouped_df[feature] = grouped_df[feature] / grouped_df[count_column].where(grouped_df[count_column] > 0)
+
+    return grouped_df
+
+def build_hotspot_pyramid(points_df, pyramid_dir,
+                          label_col='labels',
+                          risky_labels=None,
+                          features=['ndvi', 'ndbi', 'ndwi', 'ndmi',
+                                    'surface_temperature', 'precipitation_rate', 'relative_humidity'],
+                          min_zoom=8,
+                          max_zoom=14,
+                          bounds=None,
+                          region_bounds=None,
+                          hotspot_feature=None):
+    """
+    Input
+        points_df: dataframe of longitude, latitude, hotspot labels and features (e.g. from get_satellite_measures_from_points)
+        pyramid_dir: directory to write the pyramid into, one compressed .npz file per zoom level
+        label_col: column of hotspot labels
+        risky_labels: list of labels counted as risky, all labels if None
+        features: list of feature columns averaged per tile
+        min_zoom: integer, coarsest zoom level to write
+        max_zoom: integer, finest zoom level (grid cell size) to write
+        bounds: [min_lon, min_lat, max_lon, max_lat] covered by the pyramid, bounds of the points if None
+        region_bounds: optional list of the bounds of each region covered (e.g. monitored AOIs), [bounds] if None
+        hotspot_feature: optional name of the feature the labels are Gi* hotspots of, recorded in the metadata
+    Returns
+        metadata: dictionary describing the written pyramid
+    """
+
+    features = [feature for feature in features if feature in points_df.columns]
+    labels = sorted(points_df[label_col].dropna().astype(int).unique().tolist())
+    label_columns = [f'label_count_{label}' for label in labels]
+    risky_labels = labels if risky_labels is None else risky_labels
+
+    # Assign each point to a grid cell at the finest zoom level
+    x, y = lonlat_to_tile(points_df['longitude'], points_df['latitude'], max_zoom)
+    cells_df = pd.DataFrame({'x': x, 'y': y, 'count': 1,
+                             'risky_count': points_df[label_col].isin(risky_labels).astype(int).values})
+    for label, label_column in zip(labels, label_columns):
+        cells_df[label_column] = (points_df[label_col] == label).astype(int).values
+    for feature in features:
+        cells_df[feature] = points_df[feature].astype(float).values
+        cells_df[f'{feature}_count'] = points_df[feature].notna().astype(int).values
+
+    os.makedirs(pyramid_dir, exist_ok=True)
+
+    # Write from the finest level up, each level aggregated from the one below it
+    tiles_df = aggregate_tiles(cells_df, label_columns, features)
+    for zoom in range(max_zoom, min_zoom - 1, -1):
+        if zoom < max_zoom:
+            tiles_df['x'], tiles_df['y'] = tiles_df['x'] // 2, tiles_df['y'] // 2
+            tiles_df = aggregate_tiles(tiles_df, label_columns, features)
+
+        np.savez_compressed(os.path.join(pyramid_dir, f'z{zoom}.npz'),
+                            x=tiles_df['x'].values.astype(np.int32),
+                            y=tiles_df['y'].values.astype(np.int32),
+                            count=tiles_df['count'].values.astype(np.int32),
+                            risky_count=tiles_df['risky_count'].values.astype(np.int32),
+                            **{column: tiles_df[column].values.astype(np.int32) for column in label_columns},
+                            **{feature: tiles_df[feature].values.astype(np.float32) for feature in features})
+
+    if bounds is None:
+        bounds = [points_df['longitude'].min(), points_df['latitude'].min(),
+                  points_df['longitude'].max(), points_df['latitude'].max()]
+
+    if region_bounds is None:
+        region_bounds = [bounds]
+
+    metadata = {'min_zoom': min_zoom,
+                'max_zoom': max_zoom,
+                'bounds': [float(bound) for bound in bounds],
+                'region_bounds': [[float(bound) for bound in region] for region in region_bounds],
+                'labels': labels,
+                'risky_labels': [int(label) for label in risky_labels],
+                'features': features,
+                'hotspot_feature': hotspot_feature,
+                'num_points': int(len(points_df)),
+                'built_at': time.time()}
+
+    with open(os.path.join(pyramid_dir, 'pyramid.json'), 'w') as f:
+        json.dump(metadata, f)
+
+    return metadata
+
+def load_pyramid_metadata(pyramid_dir)->dict:
+    """
+    Returns the metadata of a pyramid, or None if there is no pyramid in the directory.
+    """
+
+    metadata_path = os.path.join(pyramid_dir, 'pyramid.json')
+
+    if not os.path.exists(metadata_path):
+        return None
+
+    with open(metadata_path) as f:
+        return json.load(f)
+
+def pyramid_covers(pyramid_dir, aoi_geojson)->bool:
+    """
+    Whether a pyramid exists in the directory and one of its regions contains the AOI bounding box.
+    AOIs in the gaps between the regions of a pyramid are not covered.
+    """
+
+    metadata = load_pyramid_metadata(pyramid_dir)
+
+    if metadata is None:
+        return False
+
+    lons = [point[0] for point in aoi_geojson[0]]
+    lats = [point[1] for point in aoi_geojson[0]]
+
+    return any(min_lon <= min(lons) and max(lons) <= max_lon and min_lat <= min(lats) and max(lats) <= max_lat
+               for min_lon, min_lat, max_lon, max_lat in metadata.get('region_bounds', [metadata['bounds']]))
+
+def read_hotspot_tiles(pyramid_dir, aoi_geojson, zoom=None)->pd.DataFrame:
+    """
+    Reads only the tiles of one zoom level that intersect the AOI bounding box.
+    Returns a dataframe with tile center longitude/latitude, the dominant label per tile as 'labels',
+    the highest risky label in the tile (0 if none) as 'hotspot_labels', counts, risky share and feature means,
+    which can be passed directly to visualize_on_map.
+    """
+
+    metadata = load_pyramid_metadata(pyramid_dir)
+
+    # Default to the finest level and clamp to the levels written
+    zoom = metadata['max_zoom'] if zoom is None else min(max(zoom, metadata['min_zoom']), metadata['max_zoom'])
+
+    lons = [point[0] for point in aoi_geojson[0]]
+    lats = [point[1] for point in aoi_geojson[0]]
+    min_x, min_y = lonlat_to_tile(min(lons), max(lats), zoom)
+    max_x, max_y = lonlat_to_tile(max(lons), min(lats), zoom)
+
+    with np.load(os.path.join(pyramid_dir, f'z{zoom}.npz')) as level:
+        visible = (level['x'] >= min_x) & (level['x'] <= max_x) & (level['y'] >= min_y) & (level['y'] <= max_y)
+        tiles_df = pd.DataFrame({name: level[name][visible] for name in level.files})
+
+    label_columns = [f'label_count_{label}' for label in metadata['labels']]
+
+    tiles_df['longitude'], tiles_df['latitude'] = tile_to_lonlat(tiles_df['x'], tiles_df['y'], zoom)
+    tiles_df['labels'] = np.asarray(metadata['labels'], dtype=int)[tiles_df[label_columns].values.argmax(axis=1)]
+    tiles_df['risky_share'] = tiles_df['risky_count'] / tiles_df['count']
+
+    # Ascending, so that the highest risky label present in a tile wins (e.g. 99% over 90% Gi* confidence)
+    tiles_df['hotspot_labels'] = 0
+    for label in sorted(label for label in metadata['labels'] if label in metadata['risky_labels']):
+        tiles_df.loc[tiles_df[f'label_count_{label}'] > 0, 'hotspot_labels'] = label
+
+    return tiles_df.reset_index(drop=True)
+
+def read_hotspot_points(pyramid_dir, aoi_geojson)->pd.DataFrame:
+    """
+    Reads the precomputed, reverse geocoded points of a pyramid that fall in the AOI bounding box,
+    or returns None if the pyramid was built without geocoding.
+    """
+
+    points_path = os.path.join(pyramid_dir, 'points.pkl')
+
+    if not os.path.exists(points_path):
+        return None
+
+    points_df = pd.read_pickle(points_path)
+
+    lons = [point[0] for point in aoi_geojson[0]]
+    lats = [point[1] for point in aoi_geojson[0]]
+    in_aoi = points_df['longitude'].between(min(lons), max(lons)) & points_df['latitude'].between(min(lats), max(lats))
+
+    return points_df[in_aoi].reset_index(drop=True)
+
+def precompute_hotspot_pyramid(aoi_geojsons, pyramid_dir,
+                               sample_points=500,
+                               hotspot_feature='surface_temperature',
+                               k=8,
+                               geocode=True,
+                               date_from='2021-11-01',
+                               date_to='2021-12-31',
+                               composite_dir=None,
+                               **pyramid_kwargs)->dict:
+    """
+    Batch stage for monitored regions: samples points in every AOI, extracts satellite measures,
+    finds Gi* hotspots of hotspot_feature (the same definition as the app) and writes the hotspot tile pyramid.
+    With geocode, the reverse geocoded points are also saved for the risk summaries (read_hotspot_points).
+    Meant to be run on a schedule (e.g. weekly) so that the app can read files instead of running the pipeline.
+    """
+
+    # Extract satellite measures for every region
+    points_dfs = []
+    for aoi_geojson in aoi_geojsons:
+        points = generate_random_ee_points(aoi_geojson, sample_points=sample_points)
+        satellite_df = get_satellite_measures_from_points(points, aoi_geojson, date_from=date_from, date_to=date_to,
+                                                          composite_dir=composite_dir)
+        points_dfs.append(satellite_df.drop(columns=['buffered_geometry']))
+    points_df = pd.concat(points_dfs, ignore_index=True)
+
+    # Hotspots of all regions together, labelled 1/2/3 for 90/95/99% confidence
+    hotspots_df = spatial_hotspots(points_df, hotspot_feature, k=k)
+    points_df[['gi_star_z', 'hotspot_labels']] = hotspots_df[['gi_star_z', 'hotspot_labels']]
+
+    # The pyramid spans the union of the AOI bounding boxes, but only covers the AOIs themselves
+    region_bounds = [[min(point[0] for point in aoi_geojson[0]), min(point[1] for point in aoi_geojson[0]),
+                      max(point[0] for point in aoi_geojson[0]), max(point[1] for point in aoi_geojson[0])]
+                     for aoi_geojson in aoi_geojsons]
+    bounds = [min(region[0] for region in region_bounds), min(region[1] for region in region_bounds),
+              max(region[2] for region in region_bounds), max(region[3] for region in region_bounds)]
+
+    pyramid_kwargs = {'risky_labels': [1, 2, 3], **pyramid_kwargs}
+    metadata = build_hotspot_pyramid(points_df, pyramid_dir, label_col='hotspot_labels', bounds=bounds,
+                                     region_bounds=region_bounds,
+                                     hotspot_feature=hotspot_feature, **pyramid_kwargs)
+
+    # Points of an earlier build must not outlive it
+    points_path = os.path.join(pyramid_dir, 'points.pkl')
+    if os.path.exists(points_path):
+        os.remove(points_path)
+
+    if geocode:
+        rev_geocode_df = reverse_geocode_points(points_df[['longitude', 'latitude']])
+        points_df = pd.concat([points_df, rev_geocode_df.drop(columns=['longitude', 'latitude'])], axis=1)
+        points_df.reindex(columns=HOTSPOT_POINT_COLUMNS).to_pickle(f'{points_path}.tmp')
+        os.replace(f'{points_path}.tmp', points_path)
+
+    return metadata
@@ -1,17 +1,61 @@
-import pandas as pd
-
 import streamlit as st
+import os
 import re
+import time
 
-import aedes
-from aedes.remote_sensing_utils import df_to_ee_points, generate_random_ee_points
-from aedes.remote_sensing_utils import visualize_on_map, get_satellite_measures_from_points
-from aedes.automl_utils import perform_clustering
-from aedes.osm_utils import initialize_OSM_network, get_OSM_network_data, reverse_geocode_points, reverse_geocode_center_of_geojson
+from aedes.remote_sensing_utils import visualize_on_map
+from aedes.osm_utils import reverse_geocode_center_of_geojson
+from aedes.job_utils import submit_job, get_job, make_job_id, load_job_result, start_workers, current_date_window
+from aedes.tile_utils import load_pyramid_metadata, pyramid_covers, read_hotspot_tiles, read_hotspot_points
+from aedes.spatial_stats_utils import spatial_hotspots
+from aedes.risk_report_utils import summarize_risk_by_level
 
 from streamlit_folium import folium_static
 
-aedes.remote_sensing_utils.initialize()
+SAMPLE_POINTS = 20
+N_CLUSTERS = 3
+# Days of satellite and weather data ending on the Monday of the current week
+DATE_WINDOW_DAYS = int(os.environ.get('AEDES_DATE_WINDOW_DAYS', 61))
+HOTSPOT_FEATURES = ['surface_temperature', 'relative_humidity', 'precipitation_rate', 'ndwi', 'ndvi']
+
+# Job store shared by the app and the workers. Set AEDES_WORKERS=0 when workers
+# are run separately with `python -m aedes.job_utils`.
+JOB_DB = os.environ.get('AEDES_JOB_DB', 'aedes_jobs.db')
+RESULTS_DIR = os.environ.get('AEDES_RESULTS_DIR', 'aedes_results')
+NUM_WORKERS = int(os.environ.get('AEDES_WORKERS', 2))
+
+# Hotspot tile pyramid precomputed for monitored regions with precompute_hotspot_pyramid
+PYRAMID_DIR = os.environ.get('AEDES_PYRAMID_DIR', 'aedes_pyramid')
+
+@st.cache_resource
+def start_job_workers():
+    """
+    Start the worker processes once per server process. Stage memoization and shared clients (Earth Engine,
+    OSM networks) live in the workers, see run_pipeline and get_shared_resource in aedes.pipeline_utils.
+    """
+    return start_workers(JOB_DB, RESULTS_DIR, num_workers=NUM_WORKERS)
+
+@st.cache_data(show_spinner=False)
+def get_center_address(aoi_key):
+    return reverse_geocode_center_of_geojson([[list(point) for point in aoi_key]])
+
+@st.cache_data(show_spinner=False)
+def load_finished_job_result(job_id):
+    return load_job_result(RESULTS_DIR, job_id)
+
+@st.cache_data(show_spinner=False)
+def get_spatial_hotspots(points_df, feature):
+    """
+    Gi* hotspots of the sampled points, or None if too few points have the feature (e.g. cloud-masked LST).
+    """
+    # Points without the feature are dropped by spatial_hotspots, and Gi* needs more than k+1 points,
+    # so use fewer neighbours than the module default
+    num_valid = int(points_df[feature].notna().sum())
+    if num_valid < 3:
+        return None
+    return spatial_hotspots(points_df, feature, k=min(8, num_valid - 2))
+
+start_job_workers()
 
 st.title('AEDES: Predictive Geospatial Hostpot Detection')
 st.write("""This web application demonstrates the use of satellite, weather and OpenStreetMap data to identify potential hotspots for vector-borne diseases. This web application only needs geojson input of an area of interest and then it automatically collects and models the data needed for hotspot detection at a longlat level.""")
@@ -33,71 +77,106 @@ aoi_geojson = [[[list_parsed[0], list_parsed[1]],
               [list_parsed[6], list_parsed[7]],
               [list_parsed[8], list_parsed[9]]]]
 
-st.subheader('Bounding Box Center')
-
-st.write(f"Detect hotspots around {reverse_geocode_center_of_geojson(aoi_geojson)}...")
+# Hashable key of the parsed AOI used for caching
+aoi_key = tuple(tuple(point) for point in aoi_geojson[0])
 
-points = generate_random_ee_points(aoi_geojson, sample_points=20)
-
-satellite_df = get_satellite_measures_from_points(points, aoi_geojson)
-
-clustering_model = perform_clustering(satellite_df, n_clusters=3)
-satellite_df['labels'] = pd.Series(clustering_model.labels_)
+st.subheader('Bounding Box Center')
 
-rev_geocode_df = reverse_geocode_points(satellite_df)
+st.write(f"Detect hotspots around {get_center_address(aoi_key)}...")
 
 st.subheader('Detected Hotspots')
 
-mapper = visualize_on_map(satellite_df, ignore_labels=[1])
-
-folium_static(mapper)
+# Hotspots are points whose neighbourhood is significantly high in the selected feature (Gi*)
+pyramid_metadata = load_pyramid_metadata(PYRAMID_DIR)
+pyramid_feature = pyramid_metadata.get('hotspot_feature') if pyramid_metadata else None
+hotspot_feature = st.selectbox('Hotspot feature', HOTSPOT_FEATURES,
+                               index=HOTSPOT_FEATURES.index(pyramid_feature) if pyramid_feature in HOTSPOT_FEATURES else 0)
+
+# Known regions are a file read: their hotspots and geocoded points were precomputed, so no job is queued
+if hotspot_feature == pyramid_feature and pyramid_covers(PYRAMID_DIR, aoi_geojson):
+    tiles_df = read_hotspot_tiles(PYRAMID_DIR, aoi_geojson)
+else:
+    tiles_df = None
+
+# AOIs without any precomputed tile (e.g. no sampled point fell in them) run as a job instead
+if tiles_df is not None and len(tiles_df):
+    folium_static(visualize_on_map(tiles_df, label_col='hotspot_labels'))
+
+    points_df = read_hotspot_points(PYRAMID_DIR, aoi_geojson)
+    if points_df is None:
+        st.write('No geocoded points were precomputed for this region.')
+        st.stop()
+else:
+    # The date window moves every week, so each week gets its own job instead of the first one ever run
+    date_from, date_to = current_date_window(days=DATE_WINDOW_DAYS)
+    job_params = {'aoi_geojson': aoi_geojson, 'sample_points': SAMPLE_POINTS, 'n_clusters': N_CLUSTERS,
+                  'date_from': date_from, 'date_to': date_to}
+    job_id = make_job_id(job_params)
+    job = get_job(JOB_DB, job_id)
+
+    # Identical AOIs share one job, so only queue when nobody has asked for it yet
+    if job is None:
+        submit_job(JOB_DB, job_params)
+        job = get_job(JOB_DB, job_id)
+
+    if job['status'] == 'failed':
+        st.error('Hotspot detection failed.')
+        st.code(job['error'])
+        if st.button('Retry'):
+            submit_job(JOB_DB, job_params)
+            st.rerun()
+        st.stop()
+
+    if job['status'] == 'done':
+        job_result = load_finished_job_result(job_id)
+    else:
+        st.progress(job['progress'] or 0.0)
+        st.write(f"{job['stage'] or 'Queued'}...")
+        job_result = load_job_result(RESULTS_DIR, job_id)
+
+    if 'satellite_df' not in job_result:
+        st.write('Waiting for satellite measures...')
+        time.sleep(1)
+        st.rerun()
+
+    satellite_df = job_result['satellite_df']
+    hotspots_df = get_spatial_hotspots(satellite_df[['longitude', 'latitude', hotspot_feature]], hotspot_feature)
+
+    if hotspots_df is None:
+        st.write(f'Too few sampled points have {hotspot_feature} data to detect hotspots, try another feature.')
+        st.stop()
+
+    folium_static(visualize_on_map(satellite_df.join(hotspots_df), label_col='hotspot_labels'))
+
+    if 'rev_geocode_df' not in job_result:
+        st.write('Waiting for reverse geocoding...')
+        time.sleep(1)
+        st.rerun()
+
+    # Both results keep the order of the sampled points
+    points_df = job_result['rev_geocode_df'].assign(hotspot_labels=hotspots_df['hotspot_labels'].to_numpy(),
+                                                    gi_star_z=hotspots_df['gi_star_z'].to_numpy())
 
 st.subheader('Risky Locations')
 
-indentified_risky_places_df = rev_geocode_df[rev_geocode_df['labels'].isin([0, 2])]
+is_risky = points_df['hotspot_labels'].to_numpy() > 0
+indentified_risky_places_df = points_df[is_risky]
 
 try:
-    risk_df = indentified_risky_places_df[[i for i in rev_geocode_df.columns if 'address' in i]].fillna('').value_counts().reset_index().drop(0, axis=1)
+    risk_df = indentified_risky_places_df[[i for i in points_df.columns if 'address' in i]].fillna('').value_counts().reset_index().drop(0, axis=1)
     st.dataframe(risk_df)
 except:
     st.write('OpenStreetMap returned no available data for each longitude-latitude pair.')
-    
-st.subheader('Top Villages at Risk')
-
-try:
-    risk_village_df = indentified_risky_places_df['address.village'].value_counts().reset_index().drop('address.village', axis=1).rename(columns={'index':'top_villages'})
-    st.dataframe(risk_village_df)
-except:
-    st.write('OpenStreetMap returned no available data for suburbs.')  
-    
-st.subheader('Top Suburbs at Risk')
-
-try:
-    risk_suburb_df = indentified_risky_places_df['address.suburb'].value_counts().reset_index().drop('address.suburb', axis=1).rename(columns={'index':'top_suburbs'})
-    st.dataframe(risk_suburb_df)
-except:
-    st.write('OpenStreetMap returned no available data for suburbs.')    
-
-st.subheader('Top Cities at Risk')
 
-try:
-    risk_cities_df = indentified_risky_places_df['address.city'].value_counts().reset_index().drop('address.city', axis=1).rename(columns={'index':'top_cities'})
-    st.dataframe(risk_cities_df)
-except:
-    st.write('OpenStreetMap returned no available data for cities.')
+risk_summary_df = summarize_risk_by_level(points_df.assign(risky=is_risky), score_col='gi_star_z')
 
-st.subheader('Top Postcodes at Risk')
+# One summary covers every admin level, each section shows the places with risky points
+for level, title in [('village', 'Villages'), ('suburb', 'Suburbs'), ('city', 'Cities'),
+                     ('postcode', 'Postcodes'), ('region', 'Regions')]:
+    st.subheader(f'Top {title} at Risk')
 
-try:
-    risk_postcode_df = indentified_risky_places_df['address.postcode'].value_counts().reset_index().drop('address.postcode', axis=1).rename(columns={'index':'top_postcodes'})
-    st.dataframe(risk_postcode_df)
-except:
-    st.write('OpenStreetMap returned no available data for postcodes.')
-
-st.subheader('Top Regions at Risk')
-
-try:
-    risk_region_df = indentified_risky_places_df['address.region'].value_counts().reset_index().drop('address.region', axis=1).rename(columns={'index':'top_regions'})
-    st.dataframe(risk_region_df)
-except:
-    st.write('OpenStreetMap returned no available data for region.')
+    level_df = risk_summary_df[(risk_summary_df['level'] == level) & (risk_summary_df['n_risky'] > 0)]
+    if len(level_df):
+        st.dataframe(level_df.drop(columns=['level']).rename(columns={'place': f'top_{title.lower()}'}))
+    else:
+        st.write(f'OpenStreetMap returned no available data for {title.lower()}.')
@@ -0,0 +1,317 @@
+"""
+Deterministic local stand-in for the `ee` (Earth Engine) module.
+
+Images are synthetic rasters evaluated at the center of the reduced region, and every
+`.getInfo()` call counts as one round trip and sleeps for the configured latency.
+Install it with install_fake_ee() before importing aedes.remote_sensing_utils.
+"""
+
+import sys
+import math
+import time
+import types
+import threading
+
+import numpy as np
+
+# Synthetic raster per band as (offset, amplitude) so values fall in realistic ranges
+BAND_RANGES = {'SR_B3': (9000, 2000), 'SR_B4': (9000, 2000), 'SR_B5': (15000, 4000), 'SR_B6': (12000, 3000),
+               'SR_QA_AEROSOL': (160, 60), 'LST_Day_1km': (15000, 300), 'Fpar': (50, 40),
+               'Rainf_f_tavg': (1e-4, 8e-5), 'Tair_f_inst': (300, 4), 'Psurf_f_inst': (100000, 800),
+               'Qair_f_inst': (0.015, 0.003)}
+
+class RoundTripCounter:
+    """
+    Counts getInfo() round trips and applies latency to each of them.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.round_trips = 0
+        self.lock = threading.Lock()
+
+    def hit(self):
+        with self.lock:
+            self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def reset(self):
+        with self.lock:
+            self.round_trips = 0
+
+counter = RoundTripCounter()
+
+def synthetic_raster(band, lon, lat):
+    """
+    Smooth deterministic field for a band, evaluated at a longitude and latitude.
+    """
+
+    offset, amplitude = BAND_RANGES.get(band, (0.5, 0.5))
+    phase = sum(map(ord, band))
+
+    return offset + amplitude * math.sin(lon * 37.0 + phase) * math.cos(lat * 41.0 - phase)
+
+def geometry_center(geojson):
+    """
+    Center of a GeoJSON geometry as the mean of its coordinates.
+    """
+
+    coordinates = np.asarray(geojson['coordinates'], dtype=float).reshape(-1, 2)
+
+    return coordinates[:, 0].mean(), coordinates[:, 1].mean()
+
+class ComputedObject:
+    """
+    Lazily evaluated value, resolved on getInfo().
+    """
+
+    def __init__(self, evaluate):
+        self.evaluate = evaluate
+
+    def getInfo(self):
+        counter.hit()
+        return self.evaluate()
+
+class Dictionary(ComputedObject):
+
+    def get(self, key):
+        return ComputedObject(lambda: self.evaluate().get(key))
+
+class Geometry(ComputedObject):
+
+    def __init__(self, geojson):
+        super().__init__(lambda: geojson)
+        self.geojson = geojson
+
+    @staticmethod
+    def Point(coords, lat=None, *args, **kwargs):
+        coords = [coords, lat] if lat is not None else list(coords)
+        return Geometry({'type': 'Point', 'coordinates': [float(coords[0]), float(coords[1])]})
+
+    @staticmethod
+    def Polygon(coords, *args, **kwargs):
+        return Geometry({'type': 'Polygon', 'coordinates': coords})
+
+    def buffer(self, distance):
+        # Square of +/- distance around the center, in degrees (~111km per degree)
+        lon, lat = geometry_center(self.geojson)
+        delta = distance / 111000.0
+        ring = [[lon - delta, lat - delta], [lon + delta, lat - delta], [lon + delta, lat + delta],
+                [lon - delta, lat + delta], [lon - delta, lat - delta]]
+        return Geometry({'type': 'Polygon', 'coordinates': [ring]})
+
+    def bounds(self):
+        coordinates = np.asarray(self.geojson['coordinates'], dtype=float).reshape(-1, 2)
+        (min_lon, min_lat), (max_lon, max_lat) = coordinates.min(axis=0), coordinates.max(axis=0)
+        return Geometry({'type': 'Polygon', 'coordinates': [[[min_lon, min_lat], [max_lon, min_lat], [max_lon, max_lat],
+                                                             [min_lon, max_lat], [min_lon, min_lat]]]})
+
+def to_feature(item):
+    if isinstance(item, Geometry):
+        return {'type': 'Feature', 'geometry': item.geojson, 'properties': {}}
+    if isinstance(item, Feature):
+        return item.feature
+    return item
+
+class Feature(ComputedObject):
+
+    def __init__(self, geometry, properties=None):
+        self.feature = {'type': 'Feature', 'geometry': to_feature(geometry)['geometry'], 'properties': properties or {}}
+        super().__init__(lambda: self.feature)
+
+class FeatureCollection(ComputedObject):
+
+    def __init__(self, features):
+        if isinstance(features, dict):
+            features = features['features']
+        self.features = [to_feature(item) for item in features]
+        super().__init__(lambda: {'type': 'FeatureCollection', 'features': self.features})
+
+    @staticmethod
+    def randomPoints(region, points=1000, seed=0, *args, **kwargs):
+        coordinates = np.asarray(region.geojson['coordinates'], dtype=float).reshape(-1, 2)
+        (min_lon, min_lat), (max_lon, max_lat) = coordinates.min(axis=0), coordinates.max(axis=0)
+        rng = np.random.default_rng(seed)
+        lons = rng.uniform(min_lon, max_lon, points)
+        lats = rng.uniform(min_lat, max_lat, points)
+        return FeatureCollection([Geometry.Point(lon, lat) for lon, lat in zip(lons, lats)])
+
+    def map(self, fn):
+        return FeatureCollection([to_feature(fn(Feature(Geometry(feature['geometry']), feature['properties'])))
+                                  for feature in self.features])
+
+    def size(self):
+        return ComputedObject(lambda: len(self.features))
+
+class Reducer:
+
+    @staticmethod
+    def mean():
+        return Reducer()
+
+class Filter:
+
+    @staticmethod
+    def lt(*args, **kwargs):
+        return Filter()
+
+class Image(ComputedObject):
+    """
+    Image as a function of (lon, lat) returning a dictionary of band values.
+    """
+
+    def __init__(self, source=None, image_id=None):
+        self.image_id = source if isinstance(source, str) else image_id
+        if isinstance(source, Image):
+            self.sample = source.sample
+            self.image_id = source.image_id
+        elif callable(source):
+            self.sample = source
+        else:
+            self.sample = lambda lon, lat: {band: synthetic_raster(band, lon, lat) for band in BAND_RANGES}
+        super().__init__(lambda: {'type': 'Image', 'bands': list(BAND_RANGES)})
+
+    def get(self, name):
+        return ComputedObject(lambda: {'system:id': self.image_id}.get(name))
+
+    def serialize(self):
+        return '{"type": "FakeImage"}'
+
+    def select(self, bands):
+        if isinstance(bands, str):
+            return Image(lambda lon, lat: {bands: self.sample(lon, lat)[bands]}, image_id=self.image_id)
+        return Image(lambda lon, lat: {band: self.sample(lon, lat)[band] for band in bands}, image_id=self.image_id)
+
+    def _binary(self, other, operator):
+        def sample(lon, lat):
+            (band, value), = self.sample(lon, lat).items()
+            other_value = list(other.sample(lon, lat).values())[0] if isinstance(other, Image) else other
+            return {band: operator(value, other_value)}
+        return Image(sample)
+
+    def add(self, other):
+        return self._binary(other, lambda a, b: a + b)
+
+    def subtract(self, other):
+        return self._binary(other, lambda a, b: a - b)
+
+    def multiply(self, other):
+        return self._binary(other, lambda a, b: a * b)
+
+    def divide(self, other):
+        return self._binary(other, lambda a, b: a / b if b else None)
+
+    def rename(self, name):
+        return Image(lambda lon, lat: {name: list(self.sample(lon, lat).values())[0]})
+
+    def float(self):
+        return self
+
+    def addBands(self, other):
+        return Image(lambda lon, lat: {**self.sample(lon, lat), **other.sample(lon, lat)}, image_id=self.image_id)
+
+    def expression(self, expression, band_map):
+        def sample(lon, lat):
+            values = {key: list(value.sample(lon, lat).values())[0] if isinstance(value, Image) else value
+                      for key, value in band_map.items()}
+            return {'constant': eval(expression, {'exp': math.exp}, values)}
+        return Image(sample)
+
+    def copyProperties(self, *args, **kwargs):
+        return self
+
+    def reduceRegion(self, geometry=None, reducer=None, scale=None, **kwargs):
+        geojson = geometry.geojson if isinstance(geometry, Geometry) else geometry
+        lon, lat = geometry_center(geojson)
+        return Dictionary(lambda: self.sample(lon, lat))
+
+    def reduceRegions(self, collection=None, reducer=None, scale=None, **kwargs):
+        def reduce_feature(feature):
+            lon, lat = geometry_center(feature['geometry'])
+            return {**feature, 'properties': {**feature['properties'], **self.sample(lon, lat)}}
+        return FeatureCollection([reduce_feature(feature) for feature in collection.features])
+
+class ImageCollection(ComputedObject):
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        super().__init__(lambda: {'type': 'ImageCollection', 'id': catalog})
+
+    def filterBounds(self, *args, **kwargs):
+        return self
+
+    def filterDate(self, *args, **kwargs):
+        return self
+
+    def filterMetadata(self, *args, **kwargs):
+        return self
+
+    def filter(self, *args, **kwargs):
+        return self
+
+    def sort(self, *args, **kwargs):
+        return self
+
+    def select(self, *args, **kwargs):
+        return self
+
+    def first(self):
+        return Image(image_id=f'{self.catalog}/LOWEST_CLOUD')
+
+    def median(self):
+        return Image()
+
+    def mean(self):
+        return Image()
+
+class ExportTask:
+    """
+    Asset export task, completed as soon as it is started.
+    """
+
+    def __init__(self, asset_id):
+        self.id = f'TASK_{asset_id}'
+        self.state = 'UNSUBMITTED'
+        _tasks[self.id] = self
+
+    def start(self):
+        counter.hit()
+        self.state = 'COMPLETED'
+
+_tasks = {}
+
+def get_task_status(task_id):
+    counter.hit()
+    return [{'id': task_id, 'state': _tasks[task_id].state if task_id in _tasks else 'UNKNOWN'}]
+
+def install_fake_ee(latency=0.0)->types.ModuleType:
+    """
+    Registers the fake as the `ee` module and returns it.
+    The round trip counter is available as ee.counter.
+    """
+
+    counter.latency = latency
+    counter.reset()
+
+    module = types.ModuleType('ee')
+    module.counter = counter
+    module.Authenticate = lambda *args, **kwargs: None
+    module.Initialize = lambda *args, **kwargs: None
+    module.Geometry = Geometry
+    module.Feature = Feature
+    module.FeatureCollection = FeatureCollection
+    module.Image = Image
+    module.ImageCollection = ImageCollection
+    module.Reducer = Reducer
+    module.Dictionary = Dictionary
+    module.ComputedObject = ComputedObject
+    module.Filter = Filter
+    module.deserializer = types.SimpleNamespace(fromJSON=lambda *args, **kwargs: Image())
+    to_asset = lambda image=None, assetId=None, **kwargs: ExportTask(assetId)
+    module.batch = types.SimpleNamespace(Export=types.SimpleNamespace(image=types.SimpleNamespace(toAsset=to_asset)))
+    module.data = types.SimpleNamespace(getTaskStatus=get_task_status)
+
+    sys.modules['ee'] = module
+
+    return module
@@ -0,0 +1,134 @@
+"""
+Offline scaling benchmarks for the aedes pipeline stages.
+
+Earth Engine is replaced by a fake `ee` module, Overpass and Nominatim by a local HTTP stub,
+and the street network by a synthetic pandana grid, so results are deterministic and need no
+credentials or network access. Reports wall time, round trips, bytes received, peak Python
+memory (tracemalloc) and rows/second per stage and point count.
+
+Usage:
+    python benchmarks/run_benchmarks.py --sizes 10 100 1000 --stages satellite clustering
+    python benchmarks/run_benchmarks.py --sizes 10 100 1000 10000 100000 --ee-latency 0.05 --output bench.csv
+"""
+
+import os
+import sys
+import time
+import argparse
+import functools
+import tracemalloc
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_ee import install_fake_ee
+from stub_server import start_stub_server
+from synthetic import QC_AOI, FEATURES, synthetic_points, synthetic_network
+
+STAGES = ['satellite', 'osm', 'geocode', 'clustering']
+
+def setup_backends(ee_latency, http_latency, pois_per_query):
+    """
+    Installs the fake ee module and routes Overpass and Nominatim calls to the local stub.
+    Must run before aedes modules are imported.
+    """
+
+    ee = install_fake_ee(latency=ee_latency)
+    server, stub_url, stub_stats = start_stub_server(latency=http_latency, pois_per_query=pois_per_query)
+
+    import requests
+    from pandana.loaders import osm
+    from geopy.geocoders import Nominatim
+    import aedes.osm_utils
+
+    def stub_osm_query(query):
+        response = requests.get(f'http://{stub_url}/api/interpreter', params={'data': query})
+        response.raise_for_status()
+        return response.json()
+
+    osm.make_osm_query = stub_osm_query
+    aedes.osm_utils.Nominatim = functools.partial(Nominatim, domain=stub_url, scheme='http')
+
+    return ee, stub_stats
+
+def measure(fn):
+    """
+    Runs fn and returns its wall time in seconds and peak traced memory in MB.
+    """
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    fn()
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return seconds, peak / 1e6
+
+def make_stage_runs(num_points, network):
+    """
+    Stage name to a zero-argument callable running that stage on num_points points.
+    """
+
+    from aedes.remote_sensing_utils import generate_random_ee_points, get_satellite_measures_from_points
+    from aedes.osm_utils import get_OSM_network_data, reverse_geocode_points
+    from aedes.automl_utils import perform_clustering
+
+    points_df = synthetic_points(num_points)
+
+    return {'satellite': lambda: get_satellite_measures_from_points(generate_random_ee_points(QC_AOI, num_points), QC_AOI),
+            'osm': lambda: get_OSM_network_data(network, points_df[['longitude', 'latitude']].copy(), QC_AOI,
+                                                ['clinic', 'hospital', 'doctors'], 5, 5000),
+            'geocode': lambda: reverse_geocode_points(points_df[['longitude', 'latitude']]),
+            'clustering': lambda: perform_clustering(points_df, features=['longitude', 'latitude'] + FEATURES, n_clusters=5)}
+
+def run_benchmarks(sizes, stages, ee, stub_stats, network_grid_size=100)->pd.DataFrame:
+    """
+    Runs every stage for every point count and returns one row of metrics per run.
+    Composites are cleared before every run, so each one pays for building them.
+    """
+
+    from aedes.composite_utils import clear_composites
+
+    network = synthetic_network(grid_size=network_grid_size) if 'osm' in stages else None
+    rows = []
+
+    for num_points in sizes:
+        stage_runs = make_stage_runs(num_points, network)
+        for stage in stages:
+            ee.counter.reset()
+            clear_composites()
+            stub_stats.reset()
+
+            seconds, peak_mb = measure(stage_runs[stage])
+
+            rows.append({'stage': stage,
+                         'points': num_points,
+                         'seconds': round(seconds, 4),
+                         'round_trips': ee.counter.round_trips + sum(stub_stats.requests.values()),
+                         'bytes_received': stub_stats.bytes_sent,
+                         'peak_mb': round(peak_mb, 2),
+                         'rows_per_second': round(num_points / seconds, 1) if seconds > 0 else None})
+            print(f"{stage} x {num_points} points: {seconds:.2f}s", flush=True)
+
+    return pd.DataFrame(rows)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline scaling benchmarks for aedes pipeline stages.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000], help='point counts to run')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES, help='stages to run')
+    parser.add_argument('--ee-latency', type=float, default=0.0, help='seconds added to every fake getInfo() call')
+    parser.add_argument('--http-latency', type=float, default=0.0, help='seconds added to every stub HTTP response')
+    parser.add_argument('--pois-per-query', type=int, default=50, help='amenities returned per Overpass query')
+    parser.add_argument('--network-grid-size', type=int, default=100, help='nodes per side of the synthetic street grid')
+    parser.add_argument('--output', default=None, help='optional CSV path for the results')
+    args = parser.parse_args()
+
+    ee, stub_stats = setup_backends(args.ee_latency, args.http_latency, args.pois_per_query)
+    results_df = run_benchmarks(args.sizes, args.stages, ee, stub_stats, network_grid_size=args.network_grid_size)
+    print(results_df.to_string(index=False))
+
+    if args.output is not None:
+        results_df.to_csv(args.output, index=False)
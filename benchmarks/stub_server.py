@@ -0,0 +1,114 @@
+"""
+Local HTTP stand-in for the Overpass and Nominatim APIs.
+
+Responses are deterministic functions of the request, and every request and response byte
+is counted so that benchmarks can report round trips and bytes transferred.
+"""
+
+import re
+import json
+import zlib
+import time
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+
+class StubStats:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {'overpass': 0, 'nominatim': 0}
+        self.bytes_sent = 0
+
+    def record(self, backend, num_bytes):
+        with self.lock:
+            self.requests[backend] += 1
+            self.bytes_sent += num_bytes
+
+    def reset(self):
+        with self.lock:
+            self.requests = {'overpass': 0, 'nominatim': 0}
+            self.bytes_sent = 0
+
+def overpass_response(query, pois_per_query):
+    """
+    Amenity nodes spread over the bounding box of an Overpass node query.
+    """
+
+    amenity = re.search(r'"amenity"="([^"]+)"', query).group(1)
+    lat_min, lng_min, lat_max, lng_max = map(float, re.search(r'\(([-\d.]+),([-\d.]+),([-\d.]+),([-\d.]+)\)', query).groups())
+
+    rng = np.random.default_rng(zlib.crc32(amenity.encode()))
+    lats = rng.uniform(lat_min, lat_max, pois_per_query)
+    lons = rng.uniform(lng_min, lng_max, pois_per_query)
+    id_offset = zlib.crc32(amenity.encode()) % 1000 * 100000
+
+    elements = [{'type': 'node', 'id': id_offset + i, 'lat': lat, 'lon': lon,
+                 'tags': {'amenity': amenity, 'name': f'{amenity} {i}', 'addr:city': 'Stub City'}}
+                for i, (lat, lon) in enumerate(zip(lats, lons))]
+
+    return {'elements': elements}
+
+def nominatim_response(lat, lon):
+    """
+    Reverse geocoding result whose address parts depend on a coarse grid cell of the point.
+    """
+
+    cell = f'{round(lat * 100)}_{round(lon * 100)}'
+    district = f'{round(lat * 10)}_{round(lon * 10)}'
+
+    return {'place_id': zlib.crc32(cell.encode()), 'lat': str(lat), 'lon': str(lon),
+            'display_name': f'Village {cell}, Suburb {district}, Stub City',
+            'address': {'village': f'Village {cell}', 'suburb': f'Suburb {district}', 'city': 'Stub City',
+                        'postcode': str(1000 + zlib.crc32(district.encode()) % 100), 'region': 'Stub Region',
+                        'country': 'Philippines', 'country_code': 'ph'}}
+
+def make_handler(stats, latency, pois_per_query):
+
+    class StubHandler(BaseHTTPRequestHandler):
+
+        def respond(self, backend, payload):
+            body = json.dumps(payload).encode()
+            if latency:
+                time.sleep(latency)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            stats.record(backend, len(body))
+
+        def handle_request(self, params):
+            path = urlparse(self.path).path
+            if path.endswith('/interpreter'):
+                self.respond('overpass', overpass_response(params['data'][0], pois_per_query))
+            elif path.endswith('/reverse'):
+                self.respond('nominatim', nominatim_response(float(params['lat'][0]), float(params['lon'][0])))
+            else:
+                self.send_error(404)
+
+        def do_GET(self):
+            self.handle_request(parse_qs(urlparse(self.path).query))
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+            self.handle_request(parse_qs(body))
+
+        def log_message(self, *args):
+            pass
+
+    return StubHandler
+
+def start_stub_server(latency=0.0, pois_per_query=50):
+    """
+    Starts the stub on a free local port in a daemon thread.
+    Returns the server, its base URL and its StubStats.
+    """
+
+    stats = StubStats()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(stats, latency, pois_per_query))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, f'127.0.0.1:{server.server_address[1]}', stats
@@ -0,0 +1,56 @@
+"""
+Synthetic inputs for benchmarks: AOIs, point tables and pandana street networks.
+"""
+
+import numpy as np
+import pandas as pd
+
+# Quezon City, Philippines
+QC_AOI = [[[120.98976275, 14.58936896],
+           [121.13383232, 14.58936896],
+           [121.13383232, 14.77641364],
+           [120.98976275, 14.77641364],
+           [120.98976275, 14.58936896]]]
+
+FEATURES = ['ndvi', 'ndbi', 'ndwi', 'ndmi', 'surface_temperature', 'precipitation_rate', 'relative_humidity']
+
+def synthetic_points(num_points, aoi_geojson=QC_AOI, seed=0)->pd.DataFrame:
+    """
+    Uniform random points over the AOI bounding box with synthetic satellite features.
+    """
+
+    coordinates = np.asarray(aoi_geojson[0], dtype=float)
+    (min_lon, min_lat), (max_lon, max_lat) = coordinates.min(axis=0), coordinates.max(axis=0)
+    rng = np.random.default_rng(seed)
+
+    points_df = pd.DataFrame({'longitude': rng.uniform(min_lon, max_lon, num_points),
+                              'latitude': rng.uniform(min_lat, max_lat, num_points)})
+    for feature in FEATURES:
+        points_df[feature] = rng.normal(size=num_points)
+
+    return points_df
+
+def synthetic_network(aoi_geojson=QC_AOI, grid_size=100):
+    """
+    Street grid of grid_size x grid_size nodes over the AOI bounding box as a pandana Network,
+    with edge weights in meters.
+    """
+
+    import pandana
+
+    coordinates = np.asarray(aoi_geojson[0], dtype=float)
+    (min_lon, min_lat), (max_lon, max_lat) = coordinates.min(axis=0), coordinates.max(axis=0)
+
+    lons, lats = np.meshgrid(np.linspace(min_lon, max_lon, grid_size), np.linspace(min_lat, max_lat, grid_size))
+    node_ids = np.arange(grid_size * grid_size).reshape(grid_size, grid_size)
+    nodes_df = pd.DataFrame({'x': lons.ravel(), 'y': lats.ravel()}, index=pd.Index(node_ids.ravel(), name='id'))
+
+    # Connect each node to its right and upper neighbours
+    edge_from = np.concatenate([node_ids[:, :-1].ravel(), node_ids[:-1, :].ravel()])
+    edge_to = np.concatenate([node_ids[:, 1:].ravel(), node_ids[1:, :].ravel()])
+    dx = (nodes_df.x.values[edge_to] - nodes_df.x.values[edge_from]) * 111000 * np.cos(np.radians(nodes_df.y.values[edge_from]))
+    dy = (nodes_df.y.values[edge_to] - nodes_df.y.values[edge_from]) * 111000
+    edges_df = pd.DataFrame({'from': edge_from, 'to': edge_to, 'distance': np.hypot(dx, dy)})
+
+    return pandana.Network(nodes_df.x, nodes_df.y, edges_df['from'], edges_df['to'], edges_df[['distance']],
+                           twoway=True)
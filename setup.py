@@ -17,6 +17,7 @@ setuptools.setup(
                       'geopandas',
                       'geopy',
                       'pandana',
+                      'scipy',
                       'shapely',
                       'pycaret'],
     classifiers=[